@@ -3,7 +3,7 @@
 from .controllers.insightcontroller import *
 from .controllers.stagecontroller import *
 from .controllers.zidaqcontroller import *
-from pyforms.controls import ControlButton, ControlEmptyWidget
+from pyforms.controls import ControlButton, ControlEmptyWidget, ControlCheckBox
 from .controllers.gui import ControlMatplotlib
 from .experiment import *
 import yaml
@@ -56,19 +56,36 @@ class BasicExperiment(Experiment):
 
         self._optimize_button = ControlButton('Optimize Signal')
         self._optimize_button.value = self._optimizer
+        self._fly_check = ControlCheckBox('Fly Scan')
+        self._fly_check.value = True
 
         self._tuned_spectrum_button = ControlButton('Tuned Spectrum')
         self._tuned_spectrum_button.value = self._tuned_spectrum
 
+        self._shifts_text = ControlText('Raman Shifts (cm-1):')
+        self._shifts_text.value = '2800:3100:10'
+        self._cube_frames_text = ControlText('Frames per Shift:')
+        self._cube_frames_text.value = '1'
+        self._cube_button = ControlButton('Hyperspectral Cube')
+        self._cube_button.value = self._hyperspectral_thread
+
         self._img = ControlMatplotlib(value=np.zeros([512,512]))
         self._acquire_button = ControlButton('Acquire Image')
         self._acquire_button.value = self._rtd
+        self._average_check = ControlCheckBox('Store Average Only')
+        self._average_check.value = False
+        self._bidirectional_check = ControlCheckBox('Bidirectional Scan')
+        self._bidirectional_check.value = False
 
         self._expmt_panel.value = [ self._wl_label,
                                     self._dwell_text, self._set_dwell_button,
                                     self._omega_text, self._set_omega_button,
-                                    self._optimize_button, self._acquire_button,
+                                    self._optimize_button, self._fly_check,
+                                    self._acquire_button, self._average_check,
+                                    self._bidirectional_check,
                                     self._tuned_spectrum_button,
+                                    self._shifts_text, self._cube_frames_text,
+                                    self._cube_button,
                                     self._img,
                                     self._expmt_history]
 
@@ -89,39 +106,39 @@ class BasicExperiment(Experiment):
 
     def _set_dwell(self):
         """Changing pixel dwell time automatically adjusts zidaq TC and sample rate."""
-        self._dwell = float(self._dwell_text.value.strip())/1e6
-        self._zidaq.tc_text.value = str(self._dwell/3.)
-        self._zidaq.set_tc_button.click()
-        tc = self._zidaq.tc
-
-        self._zidaq.rate_text.value = str(2./dwell)
-        self._zidaq.set_rate_button.click()
-        rate = self._zidaq.rate
-
-        msg = 'Lockin TC changed to %f.  Sampling rate changed to %f' % (tc, rate)
+        try:
+            self._dwell = float(self._dwell_text.value.strip())/1e6
+            # Both settings in one round trip to the lockin
+            self._zidaq.set_nodes({'demods/0/timeconstant': self._dwell/3.,
+                                   'demods/0/rate': 2./self._dwell})
+            tc = self._zidaq.tc
+            rate = self._zidaq.rate
+            self._zidaq.tc_text.value = str(tc)
+            self._zidaq.rate_text.value = str(rate)
+
+            msg = 'Lockin TC changed to %f.  Sampling rate changed to %f' % (tc, rate)
+        except Exception as e:
+            msg = 'Lockin settings not changed. %s' % (str(e))
+        self._update_history(msg)
 
     def _set_omega(self):
         """Appropriately tune wavelength and delay stage for a specified omega"""
-        # Need access to tune_wl_val and tune_wl_button on the insight
-        # Need access to absmov_button and gotopos_text on the stage
         try:
-            # Tune wl
             wl = self._calc_wl(float(self._omega_text.value))
-            self._insight.tune_wl_val.value = str(wl)
-            self._insight.tune_wl_button.click()
+            try:
+                move = self._calib.stage(wl)
+                msg = 'Wavelength changed to %i nm.  Delay stage moved.' % (wl)
+                if not self._calib.in_range(wl):
+                    msg += ' Stage position extrapolated from calibration.'
+            except CalibrationError as e:
+                move = None
+                msg = 'Wavelength changed to %i nm. No delay stage calibration' % (wl)
+
+            # Tune wl and delay together
+            self._tune(wl, move)
             self._calc_omega()
             self._omega_text.value = '%.2f' % (self._omega)
             self._wl_label.value = 'Main Wavelength: %s' % (str(self._insight.opo_wl))
-
-            # Tune delay appropriately
-            move = self._calib_dict['stage'][str(wl)]
-            self._delaystage.gotopos_text.value = str(move)
-            self._delaystage.absmov_button.click()
-
-            msg = 'Wavelength changed to %i nm.  Delay stage moved.' % (wl)
-            self._update_history(msg)
-        except KeyError as e:
-            msg = 'Wavelength changed to %i nm. No delay stage calibration' % (wl)
             self._update_history(msg)
         except Exception as e:
             msg = 'Wavelength note changed. %s' % (str(e))
@@ -157,44 +174,186 @@ class BasicExperiment(Experiment):
         # Figure out how to add trigger for olympus
 
         # Acquire data from lockin
-        self._zidaq.start_daq((512, 512), self._dwell, num_frames=3)
-
-        while self._zidaq.acquiring:
-            daq_data = self._zidaq.read_daq()
-            if daq_data.any():
-                self._daq_queue.put(daq_data)
+        acc = FrameAccumulator((512, 512))
+        reduce = self._average_check.value
+        store = None
+        if not reduce:
+            # Frames can be followed live from the acquisition file, see
+            # util.data.FrameFollower
+            store = self._data.new_acquisition((512, 512), meta)
+            self._update_history('Acquiring to %s' % (store.group.file.filename))
+            self._writer.reset_stats()
+        self._acquire_frames(acc, 3, store)
 
         self._daq_queue.put('Done')
-
-        # Image formation and data storage
-        self._data.store(daq_data, meta)
+        m = self._zidaq.metrics.snapshot()
+        msg = 'Acquired %i of %i frames at %.0f samples/s.  %i samples lost.' \
+            % (m['frames_completed'], m['frames_expected'], m['samples_per_s'], m['sample_loss'])
+        if store is not None:
+            w = self._writer.stats
+            msg += '  Writer backlog %i frames max, %i dropped, %.1f MB/s.' \
+                % (w['backlog_max'], w['dropped'], w['write_bandwidth']/1e6)
+        self._update_history(msg)
+
+        # Final metrics go with the acquisition.  If asked, only the average
+        # and its SNR map are stored
+        if store is not None:
+            self._writer.flush()
+            self._data.finish_acquisition(store, self._daq_metadata({}))
+        else:
+            meta = self._daq_metadata(meta)
+            meta['frames'] = acc.frames
+            self._data.store_im(acc.mean, meta)
+            self._data.store_im(acc.snr, dict(meta, reduction='snr'))
 
         # Close shutters again
         self._insight.main_shutter_button.click()
         self._insight.fixed_shutter_button.click()
 
 
+    def _acquire_frames(self, acc, num_frames, store=None):
+        """
+        Acquire frames from the lockin into a FrameAccumulator.  Device status
+        queries are paused so they do not compete with the acquisition.
+
+        Args:
+            acc (FrameAccumulator): accumulator frames are added to.
+            num_frames (int): frames to acquire.
+            store (FrameStore): store frames are also written to, or None.
+        """
+        with status_scheduler.paused():
+            self._zidaq.start_daq((512, 512), self._dwell, num_frames=num_frames,
+                                  bidirectional=self._bidirectional_check.value)
+            reader = self._zidaq.frames.reader()
+            daq_thread = threading.Thread(name='DAQ Reader Thread',
+                                          target=self._zidaq.read_daq)
+            daq_thread.daemon = True
+            daq_thread.start()
+
+            # Frames are averaged as they arrive, straight from the frame buffer
+            while daq_thread.is_alive() or reader.available():
+                seq, daq_data = reader.read(timeout=0.1)
+                if daq_data is None:
+                    continue
+                acc.add(daq_data)
+                self._img.value = acc.mean
+                if store is not None:
+                    # Metrics so far and frame timestamp as per-frame metadata
+                    frame_meta = self._zidaq.metrics.snapshot()
+                    frame_meta['timestamp'] = self._zidaq.frames.get(seq)[1]
+                    self._writer.put(store, daq_data, frame_meta)
+            reader.close()
+
+    def _parse_shifts(self, text):
+        """
+        Return the Raman shifts of a shift list, either start:stop:step, stop
+        included, or comma separated values.
+        """
+        if ':' in text:
+            start, stop, step = [float(v) for v in text.split(':')]
+            return np.arange(start, stop + step/2., step)
+        return np.array([float(v) for v in text.split(',')])
+
+    def _hyperspectral_thread(self):
+        """Start thread for hyperspectral cube acquisition"""
+        self._hyperspectralThread = threading.Thread(name='Hyperspectral Cube Thread',
+                                                     target=self._hyperspectral)
+        self._hyperspectralThread.daemon = True
+        self._hyperspectralThread.start()
+
+    def _hyperspectral(self):
+        """
+        Acquires a hyperspectral cube: an averaged image at each Raman shift of
+        the shift list, with the laser tuned and the delay stage moved to its
+        calibrated position for each.
+        """
+        try:
+            omegas = self._parse_shifts(self._shifts_text.value)
+            num_frames = int(self._cube_frames_text.value.strip())
+            # 0 frames would start an endless acquisition
+            if num_frames < 1:
+                raise ValueError('Frames per shift must be at least 1.')
+        except ValueError as e:
+            self._update_history('Hyperspectral cube not acquired. %s' % (str(e)))
+            return
+        meta = self._get_metadata()
+        meta['frames_per_shift'] = num_frames
+        cube = self._data.new_cube(omegas, (512, 512), meta)
+        self._update_history('Acquiring %i shifts to %s' % (len(omegas), cube.group.file.filename))
+
+        self._insight.main_shutter_button.click()
+        self._insight.fixed_shutter_button.click()
+        t_start = time.time()
+        done = 0
+        try:
+            for i, omega in enumerate(omegas):
+                wl = self._calc_wl(omega)
+                try:
+                    move = self._calib.stage(wl)
+                except CalibrationError:
+                    move = None
+                # Stage moves while the laser tunes
+                self._tune(wl, move)
+                self._calc_omega()
+                self._omega_text.value = '%.2f' % (self._omega)
+
+                t = time.time()
+                acc = FrameAccumulator((512, 512))
+                self._acquire_frames(acc, num_frames)
+                cube.write(i, acc.mean, omega_measured=self._omega,
+                           wavelength=self._insight.opo_wl, stage=self._delaystage.pos,
+                           time=t, frames=acc.frames)
+                done += 1
+        except Exception as e:
+            self._update_history('Hyperspectral cube stopped. %s' % (str(e)))
+        finally:
+            # Close shutters again
+            self._insight.main_shutter_button.click()
+            self._insight.fixed_shutter_button.click()
+
+        self._data.finish_acquisition(cube, self._daq_metadata({}))
+        stats = self._insight.tune_stats
+        msg = 'Hyperspectral cube: %i of %i shifts acquired in %.1f s.  Tuning time %.2f s mean.' \
+                            % (done, len(omegas), time.time() - t_start, stats['mean'])
+        self._update_history(msg)
+
     def _tuned_spectrum(self):
         """Acquires a spectrum over calibrated wavelength range"""
-        keys = self._calib_dict['stage'].keys()
+        wls = self._calib.wavelengths
+        if len(wls) == 0:
+            self._update_history('Tuned spectrum not acquired. No calibrated wavelengths.')
+            return
+        keys = np.arange(int(wls[0]), int(wls[-1]) + 1)
+        try:
+            moves = self._calib.stage(keys)
+        except CalibrationError as e:
+            self._update_history('Tuned spectrum not acquired. %s' % (str(e)))
+            return
         omegas = np.zeros([len(keys)])
         srs = np.zeros([len(keys)])
-        for i, wl in enumerate(keys):
-            print(wl)
-            self._insight.tune_wl_val.value = str(wl)
-            self._insight.tune_wl_button.click()
-            time.sleep(3)
-            self._calc_omega()
-            self._omega_text.value = '%.2f' % (self._omega)
-
-            move = self._calib_dict['stage'][str(wl)]
-            self._delaystage.gotopos_text.value = str(move)
-            self._delaystage.absmov_button.click()
-            time.sleep(1)
-
-            x, y, frame, line = self._zidaq.poll()
-            omegas[i] = self._omega
-            srs[i] = np.mean((x**2 + y**2)**0.5)
+        with self._zidaq.poll_session() as session:
+            for i, wl in enumerate(keys):
+                # Stage moves while the laser tunes.  Tuning returns once the
+                # laser has settled
+                self._tune(wl, float(moves[i]))
+                self._calc_omega()
+                self._omega_text.value = '%.2f' % (self._omega)
+
+                samples = session.poll()
+                omegas[i] = self._omega
+                srs[i] = np.mean((samples['x']**2 + samples['y']**2)**0.5)
+
+        stats = self._insight.tune_stats
+        msg = 'Tuned spectrum acquired.  Tuning time %.2f s mean, %.2f s max.' \
+                                                    % (stats['mean'], stats['max'])
+        self._update_history(msg)
+
+    def _daq_metadata(self, meta):
+        """Return metadata with the current lockin data path metrics added"""
+        meta = dict(meta)
+        for key, val in self._zidaq.metrics.snapshot().items():
+            meta['zidaq/metrics/%s' % (key)] = val
+        return meta
 
     def _get_metadata(self):
         """Todo: Return metadata dictionary based on current parameters"""
@@ -220,8 +379,15 @@ class BasicExperiment(Experiment):
     # Functions for optimizing signal vs delay stage position
 
     def _optimizer(self):
-        """Start thread for optimize function from parent class using current delay stage position."""
+        """
+        Start thread for optimize function from parent class using current delay
+        stage position.  Uses a continuous scan if Fly Scan is checked.
+        """
+        if self._fly_check.value:
+            target = self._fly_optimize
+        else:
+            target = self._optimize
         self._optimizerThread = threading.Thread(name='Signal Optimizer Thread', \
-                            target=self._optimize, args=(self._delaystage.pos,))
+                            target=target, args=(self._delaystage.pos,))
         self._optimizerThread.daemon = True
         self._optimizerThread.start()
\ No newline at end of file
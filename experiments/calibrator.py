@@ -8,7 +8,7 @@ from .experiment import *
 import yaml
 import time
 
-class Calibrator(BaseWidget):
+class Calibrator(Experiment):
     """
     Extended experiment class for wavelength vs stage delay.
 
@@ -26,43 +26,63 @@ class Calibrator(BaseWidget):
         # Experiment history log from parent Experiment class
         Experiment._expmt_widgets(self)
 
-        self._wl_range_text = ControlText('Wavelength Range to Calibrate:')
+        self._wl_range_text = ControlText('Wavelength Range to Calibrate (min-max:step):')
 
         self._calibrate_button = ControlButton('Calibrate')
         self._calibrate_button.value = self._calibrator
 
         self._expmt_panel.value = [ self._wl_range_text,
                                     self._calibrate_button,
-                                    self.expmt_history]
+                                    self._expmt_history]
 
     ############################################################################
     # Functions for optimizing signal vs delay stage position
 
     def _get_wavelength_range(self):
-        """Parse user specified wavelength calibration range"""
+        """
+        Parse user specified wavelength calibration range, 'min-max' or
+        'min-max:step' for a sparse calibration.
+        """
         text = self._wl_range_text.value
+        step = 1
+        if ':' in text:
+            text, step = text.split(':')
+            step = int(step)
         wlrange = text.split('-')
         wlmin = int(wlrange[0])
         wlmax = int(wlrange[1])
-        return np.linspace(wlmin, wlmax, wlmin-wlmax+1)
+        return np.arange(wlmin, wlmax + 1, step)
 
     def _calibrator(self):
         """Start calibration thread with target _calibrate"""
         self._calibratorThread = threading.Thread(target=self._calibrate)
         self._calibratorThread.start()
 
-    def _calibrate(self):
+    def _calibrate(self, strategy=None):
         """
         Call parent _optimize iteratively over wavelength range specified.
         Use current calibration as starting position, if not guess
+
+        Args:
+            strategy (object): peak search strategy, see util/search.py.
+                Defaults to the experiment search strategy.
         """
         wls = self._get_wavelength_range()
+        total = 0
         for i, wl in enumerate(wls):
-            self.insight.tune_wl_val.value = str(int(wl))
-            self.insight.tune_wl_button.click()
-            print(wl)
-            time.sleep(2)
+            # Start from the calibration model, or the current position if
+            # there is no calibration yet
             try:
-                self._optimize(self.t0_dict['stage'][str(int(wl))])
-            except KeyError as e:
-                self._optimize(self.t0_dict['stage'][str(int(wl) - 1)] + .25)
\ No newline at end of file
+                pos = self._calib.stage(wl)
+            except CalibrationError as e:
+                pos = self._delaystage.pos
+            # Stage moves to the start position while the laser tunes
+            self._tune(int(wl), pos)
+            result = self._optimize(pos, strategy)
+            if result is None:
+                msg = 'Calibration stopped at %i nm.' % (int(wl))
+                break
+            total += result.num_measurements
+        else:
+            msg = 'Calibrated %i wavelengths with %i measurements.' % (len(wls), total)
+        self._update_history(msg)
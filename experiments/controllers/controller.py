@@ -2,6 +2,8 @@
 
 import pyforms
 import threading
+import time
+from .scheduler import *
 from pyforms import BaseWidget
 from pyforms.controls import ControlText, ControlButton, ControlLabel
 from pyforms.controls import ControlTextArea
@@ -13,7 +15,13 @@ class Controller(BaseWidget):
     Args:
         formset (dict/list): dictionary/list for GUI organization.
         title (str): name of GUI window.
+
+    Attributes:
+        status_period (float): time between _status calls, None for no status
+            queries. Units (s)
     """
+    status_period = None
+
     def __init__(self, formset, title='Controller'):
         BaseWidget.__init__(self, title)
         self.set_margin(10)
@@ -27,10 +35,11 @@ class Controller(BaseWidget):
         # Record initiliazation
         self._update_history()
 
-        # Status query threading
-        self.queryThread = threading.Thread(name='%s Query Thread' % (title), target=self._status)
-        self.queryThread.daemon = True
-        self.queryThread.start()
+        # Status queries run on the shared status scheduler thread
+        self._status_job = None
+        if self.status_period:
+            self._status_job = status_scheduler.register(self._status,
+                                                         self.status_period)
 
     ############################################################################
     # GUI Widgets
@@ -58,6 +67,5 @@ class Controller(BaseWidget):
         return self._action_history
 
     def _status(self):
-        """Empty device status function"""
-        while 1:
-            pass
\ No newline at end of file
+        """Empty device status function.  Called every status_period seconds."""
+        pass
\ No newline at end of file
@@ -0,0 +1,68 @@
+#! /usr/bin/env python
+
+import threading
+import time
+
+class StateCache(object):
+    """
+    Cached device state with a time-to-live per field.  Fresh values are
+    returned from memory, stale or missing values are queried from the device.
+    The whole cache is invalidated when the device receives a command.
+
+    Args:
+        ttl (dict): time-to-live per field name.  Fields not listed are not
+            cached. Units (s)
+    """
+    def __init__(self, ttl=None):
+        self.ttl = dict(ttl or {})
+        self._values = {} # field: (value, time stored)
+        self._generation = 0 # Incremented on invalidation
+        self._lock = threading.Lock()
+
+    def get(self, field):
+        """Return the cached value of a field, or None if missing or stale."""
+        with self._lock:
+            try:
+                value, t = self._values[field]
+            except KeyError:
+                return None
+        if time.monotonic() - t > self.ttl.get(field, 0):
+            return None
+        return value
+
+    def set(self, field, value, generation=None):
+        """
+        Store the value of a field.
+
+        Args:
+            field (str): field name.
+            value (object): value read from the device.
+            generation (int): generation when the read was started.  The value
+                is dropped if the cache was invalidated since.
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._values[field] = (value, time.monotonic())
+
+    def fetch(self, field, query):
+        """
+        Return the cached value of a field if fresh, otherwise call query and
+        cache its result.
+
+        Args:
+            field (str): field name.
+            query (callable): reads the value from the device.
+        """
+        value = self.get(field)
+        if value is None:
+            generation = self._generation
+            value = query()
+            self.set(field, value, generation)
+        return value
+
+    def invalidate(self):
+        """Forget all cached values"""
+        with self._lock:
+            self._values = {}
+            self._generation += 1
@@ -55,17 +55,90 @@ class CommandError(Exception):
     def __str__(self):
         return self.msg
 
+class MotionError(Exception):
+    """Exception for a move that did not complete in time"""
+    def __init__(self, target, timeout):
+        self.msg = 'Move to %f not complete after %.2f s' % (target, timeout)
+
+    def __str__(self):
+        return self.msg
+
+class MoveHandle(object):
+    """
+    Handle to a delay stage move in progress.  Returned by DelayStage.move.
+    Motion completion is detected by polling the stage state until it leaves
+    MOVING.
+
+    Args:
+        stage (DelayStage): stage that was commanded to move.
+        target (float): absolute target position. Units (mm)
+        timeout (float): time allowed for the move to complete. Units (s)
+        poll_time (float): interval between state queries. Units (s)
+    """
+    def __init__(self, stage, target, timeout, poll_time):
+        self.stage = stage
+        self.target = target
+        self.timeout = timeout
+        self.poll_time = poll_time
+
+        self.t_start = time.time()
+        self.elapsed = None # Move duration, set when completion is seen
+
+    def done(self):
+        """Query the stage state once and return True if no longer moving."""
+        if self.elapsed is not None:
+            return True
+        self.stage.query_state()
+        if self.stage._state == '28':
+            return False
+        self.elapsed = time.time() - self.t_start
+        # Positions cached while moving are stale now
+        self.stage._cache.invalidate()
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Block until the move is complete, then check errors and read back
+        the position.
+
+        Args:
+            timeout (float): overrides the handle timeout. Units (s)
+
+        Returns:
+            pos (float): position reached. Units (mm)
+        """
+        if timeout is None:
+            timeout = self.timeout
+        while not self.done():
+            if time.time() - self.t_start > timeout:
+                raise MotionError(self.target, timeout)
+            time.sleep(self.poll_time)
+        self.stage.check_errors()
+        return self.stage.pos
+
+    def stop(self):
+        """Stop the move in progress"""
+        self.stage.stop_motion()
+
 class DelayStage(Device):
     """
     Facilitates serial communication with newport delay stage.
 
     Args:
         port (str): COM for serial communication.  This is a windows feature.
-        com_time (float): wait time to allow read/write of serial commands.
+        com_time (float): Not in use.  Motion completion is polled, see move.
+        timeout (float): deadline for replies to serial queries. Units (s)
+        poll_time (float): interval between state queries during motion. Units (s)
+        ttl (dict): cache time-to-live for pos, vel and accel properties,
+            overriding the defaults. Units (s)
     """
-    def __init__(self, port=None, com_time=0.1):
+    # Position changes while moving, velocity and acceleration only on command
+    _ttl = {'pos': 0.1, 'vel': 60., 'accel': 60.}
+
+    def __init__(self, port=None, com_time=0.1, timeout=1., poll_time=0.01,
+                 ttl=None):
         # Initialize serial communications with port and open that port
-        Device.__init__(self, port)
+        Device.__init__(self, port, timeout, dict(self._ttl, **(ttl or {})))
         self.open_com()
 
         self._states = {
@@ -86,7 +159,8 @@ class DelayStage(Device):
             '3D' : 'DISABLE from MOVING.',
             '!!' : 'State unknown. Error.'
         }
-        self._com_time = com_time # Wait time for read/write
+        self._com_time = com_time
+        self.poll_time = poll_time # State query interval while moving
 
         # Place holders for state and errors
         self._pos_error = '0000'
@@ -94,22 +168,19 @@ class DelayStage(Device):
         self._state = '0A'
 
         # Initialize values
-        self.write(b'1TP?', self._com_time)
-        self._pos = float(self.read()[3:])
-        self.write(b'1VA?', self._com_time)
-        self._vel = float(self.read()[3:])
-        self.write(b'1AC?', self._com_time)
-        self._accel = float(self.read()[3:])
+        self._pos = self.pos
+        self._vel = self.vel
+        self._accel = self.accel
 
     ############################################################################
     # Enable, disable and delay stage homing
 
     # Re-enter READY state
+    @transaction
     def enable(self):
         """Enter delay stage READY state to allow for motion."""
         try:
-            self.write(b'1MM1', self._com_time)
-            tmp = self.read()
+            self.write(b'1MM1')
             self.check_errors()
             self.last_action = 'Entered READY state'
         except PositionerError as e:
@@ -120,11 +191,11 @@ class DelayStage(Device):
             self.last_action = 'Unknown error. %s' % (str(e))
 
     # Enter DISABLE state
+    @transaction
     def disable(self):
         """Enter delay stage disable state."""
         try:
-            self.write(b'1MM0', self._com_time)
-            tmp = self.read()
+            self.write(b'1MM0')
             self.check_errors()
             self.last_action = 'Entered DISABLE state'
         except PositionerError as e:
@@ -134,13 +205,13 @@ class DelayStage(Device):
         except Exception as e:
             self.last_action = 'Unknown error. %s' % (str(e))
 
+    @transaction
     def home(self):
         """Home the delay stage.  Home position is a system parameter."""
         # 'Home' the delay stage and get current position,
         # a value from -100 to 100 mm
         try:
-            self.write(b'1OR', self._com_time)
-            tmp = self.read()
+            self.write(b'1OR')
             self.check_errors()
         except PositionerError as e:
             self.last_action = 'Positioner Error: %s' % (str(e))
@@ -157,8 +228,7 @@ class DelayStage(Device):
     # to the state of the device.
     def query_state(self):
         """Get current positioner errors and state."""
-        self.write(b'1TS', self._com_time)
-        line = self.read()
+        line = self.query(b'1TS')
         self._pos_error = line[3:7]
         self._state = line[7:9]
 
@@ -177,10 +247,10 @@ class DelayStage(Device):
 
     # Read last command error, and query state to see if there are positioner
     # errors
+    @transaction
     def check_errors(self):
         """Check for command errors and also call query_state"""
-        self.write(b'1TE', self._com_time) # Last command error
-        self._cmd_error = self.read()[3:].strip()
+        self._cmd_error = self.query(b'1TE')[3:].strip() # Last command error
         if self._cmd_error != '@':
             raise CommandError(self._cmd_error)
         self.query_state()
@@ -196,37 +266,40 @@ class DelayStage(Device):
     # from relative move, and is used as the program waiting time.
     # Stop motion is not a property.
 
+    # Device reads behind the cached position, velocity and acceleration
+    # properties
+    def _read_pos(self):
+        """Query current position"""
+        return float(self.query(b'1TP?')[3:])
+
+    def _read_vel(self):
+        """Query current velocity"""
+        return float(self.query(b'1VA?')[3:])
+
+    def _read_accel(self):
+        """Query current acceleration"""
+        return float(self.query(b'1AC?')[3:])
+
     @property
     def pos(self):
         """
-        Property for delay stage position.  Writes to stage to get current
-        position.
+        Property for delay stage position.  Returns the cached value if fresh,
+        otherwise writes to stage to get current position.
         """
-        self.write(b'1TP?', self._com_time)
-        self._pos = float(self.read()[3:])
+        self._pos = self._cache.fetch('pos', self._read_pos)
         return self._pos
 
     @pos.setter
     def pos(self, val):
         """
-        Delay stage position setter.  Writes to delay stage to move and reads
-        back actual position.
+        Delay stage position setter.  Writes to delay stage to move, waits for
+        motion to complete and reads back actual position.
 
         Args:
             val (float): absolute delay stage position to move to (-100, 100). Units (mm).
         """
         try:
-            relative_move = np.abs(val - self._pos)
-            self.write(b'1PT%f' % relative_move, self._com_time)
-            t = float(self.read()[3:])
-
-            self.write(b'1PA%f' % val, t + self._com_time)
-            tmp = self.read()
-            self.check_errors()
-
-            self.write(b'1TP?', self._com_time)
-            self._pos = float(self.read()[3:])
-
+            self.move(val)
             self.last_action = 'Position moved to: %s' % (self._pos)
 
         except PositionerError as e:
@@ -235,16 +308,107 @@ class DelayStage(Device):
         except CommandError as e:
             self.last_action = 'Position not moved! Command Error: %s' \
                                                                     % (str(e))
+        except MotionError as e:
+            self.last_action = 'Position not reached! %s' % (str(e))
         except Exception as e:
             self.last_action = 'Position not moved! Unknown error. %s' \
                                                                     % (str(e))
 
+    def move(self, val, wait=True, poll_time=None, timeout=None):
+        """
+        Absolute move.  Errors are raised rather than logged, see pos setter.
+
+        Args:
+            val (float): absolute delay stage position to move to (-100, 100). Units (mm).
+            wait (bool): block until motion is complete.  If False, returns
+                immediately and the handle can be waited on.
+            poll_time (float): interval between state queries. Defaults to stage poll_time. Units (s)
+            timeout (float): time allowed for the move. Defaults to twice the
+                controller's estimated move time plus 1 s. Units (s)
+
+        Returns:
+            handle (MoveHandle): handle to the move.
+        """
+        if poll_time is None:
+            poll_time = self.poll_time
+        if timeout is None:
+            relative_move = np.abs(val - self._pos)
+            t = float(self.query(b'1PT%f' % relative_move)[3:])
+            timeout = 2*t + 1.
+
+        self.write(b'1PA%f' % val)
+        handle = MoveHandle(self, val, timeout, poll_time)
+        if wait:
+            handle.wait()
+        return handle
+
+    ############################################################################
+    # Motion profile.  The controller moves with a trapezoidal velocity profile:
+    # constant acceleration to the set velocity, cruise, constant deceleration.
+    # Short moves never reach the set velocity and are triangular.  Uses the
+    # last known velocity and acceleration, jerk time is neglected.
+
+    def _profile(self, distance, vel=None, accel=None):
+        """
+        Return peak velocity, acceleration time and cruise time of a move, with
+        the current velocity and acceleration unless given.
+        """
+        v = self._vel if vel is None else vel
+        a = self._accel if accel is None else accel
+        ta = v/a
+        if a*ta**2 > distance:
+            ta = np.sqrt(distance/a)
+            v = a*ta
+        tc = (distance - a*ta**2)/v if v else 0
+        return v, ta, tc
+
+    def move_time(self, start, stop, vel=None, accel=None):
+        """
+        Duration of a move from start to stop according to the motion profile.
+
+        Args:
+            start (float): start position. Units (mm)
+            stop (float): end position. Units (mm)
+            vel (float): velocity, None for the current velocity. Units (mm/s)
+            accel (float): acceleration, None for the current. Units (mm/s^2)
+        """
+        v, ta, tc = self._profile(np.abs(stop - start), vel, accel)
+        return 2*ta + tc
+
+    def trajectory(self, start, stop, t, vel=None, accel=None):
+        """
+        Position along a move from start to stop at times after the move was
+        commanded.  Vectorized over t.
+
+        Args:
+            start (float): start position. Units (mm)
+            stop (float): end position. Units (mm)
+            t (np array): times since start of the move. Units (s)
+            vel (float): velocity of the move, None for the current velocity.
+                Units (mm/s)
+            accel (float): acceleration of the move, None for the current.
+                Units (mm/s^2)
+
+        Returns:
+            pos (np array): stage positions. Units (mm)
+        """
+        a = self._accel if accel is None else accel
+        d = np.abs(stop - start)
+        v, ta, tc = self._profile(d, vel, a)
+        T = 2*ta + tc
+
+        t = np.clip(np.asarray(t, dtype=float), 0, T)
+        x = np.where(t < ta, 0.5*a*t**2,
+                     np.where(t < ta + tc, 0.5*a*ta**2 + v*(t - ta),
+                              d - 0.5*a*(T - t)**2))
+        return start + np.sign(stop - start)*x
+
     # Stop any motion
+    @transaction
     def stop_motion(self):
         """Stop currently moving delay stage"""
         try:
-            self.write(b'1ST', self._com_time)
-            tmp = self.read()
+            self.write(b'1ST')
             if self._cmd_error != '@':
                 raise CommandError(self._cmd_error)
 
@@ -252,8 +416,7 @@ class DelayStage(Device):
             if int(self._pos_error, 16):
                raise PositionerError(self._pos_error)
 
-            self.write(b'1TP?', self._com_time)
-            self._pos = float(self.read()[3:])
+            self._pos = self.pos
             self.last_action = 'Motion stopped at: %s' % (self._pos)
         except PositionerError as e:
             self.last_action = 'Positioner Error: %s' % (str(e))
@@ -268,14 +431,14 @@ class DelayStage(Device):
     @property
     def vel(self):
         """
-        Property for delay stage velocity.  Writes to stage to get current
-        velocity.
+        Property for delay stage velocity.  Returns the cached value if fresh,
+        otherwise writes to stage to get current velocity.
         """
-        self.write(b'1VA?', self._com_time)
-        self._vel = float(self.read()[3:])
+        self._vel = self._cache.fetch('vel', self._read_vel)
         return self._vel
 
     @vel.setter
+    @transaction
     def vel(self, val):
         """
         Delay stage velocity setter.  Writes to delay stage to change and reads
@@ -285,12 +448,10 @@ class DelayStage(Device):
             val (float): delay stage velocity. Units (mm/s)
         """
         try:
-            self.write(b'1VA%f' % val, self._com_time)
-            tmp = self.read()
+            self.write(b'1VA%f' % val)
             self.check_errors()
 
-            self.write(b'1VA?', self._com_time)
-            self._vel = float(self.read()[3:])
+            self._vel = self.vel
 
             self.last_action = 'Velocity changed to: %s' % (self._pos)
 
@@ -310,14 +471,14 @@ class DelayStage(Device):
     @property
     def accel(self):
         """
-        Property for delay stage acceleration.  Writes to stage to get current
-        acceleration.
+        Property for delay stage acceleration.  Returns the cached value if fresh,
+        otherwise writes to stage to get current acceleration.
         """
-        self.write(b'1AC?', self._com_time)
-        self._accel = float(self.read()[3:])
+        self._accel = self._cache.fetch('accel', self._read_accel)
         return self._accel
 
     @accel.setter
+    @transaction
     def accel(self, val):
         """
         Delay stage acceleration setter.  Writes to delay stage to change and reads
@@ -327,12 +488,10 @@ class DelayStage(Device):
             val (float): delay stage acceleration. Units (mm/s2)
         """
         try:
-            self.write(b'1AC%f' % val, self._com_time)
-            tmp = self.read()
+            self.write(b'1AC%f' % val)
             self.check_errors()
 
-            self.write(b'1AC?', self._com_time)
-            self._accel = float(self.read()[3:])
+            self._accel = self.accel
         except PositionerError:
             self.last_action = 'Acceleration not changed! Positioner Error: %s'\
                                                                     % (str(e))
@@ -352,8 +511,7 @@ class DelayStage(Device):
     #    try:
     #        self.write(b'1HT1')
     #        self.check_errors()
-    #        self.write(b'1TP?', self._com_time)
-    #        self._pos = float(self.read()[3:])
+    #        self._pos = float(self.query(b'1TP?')[3:])
     #        self.last_action = 'HOME set to %s: ' % (self._pos)
     #    except PositionerError as e:
     #        self.last_action = 'Positioner Error: %s' % (e.msg)
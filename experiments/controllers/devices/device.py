@@ -3,6 +3,8 @@
 import serial
 import time
 from AnyQt.QtCore import QObject
+from .executor import *
+from .cache import *
 
 class ComError(Exception):
     """Exception for no com input -- For delay stage and insight"""
@@ -12,25 +14,42 @@ class ComError(Exception):
     def __str__(self):
         return self.msg
 
+class ResponseError(Exception):
+    """Exception for a query whose terminated reply did not arrive in time"""
+    def __init__(self, command, timeout):
+        self.msg = 'No reply to %s within %.3f s' % (command, timeout)
+
+    def __str__(self):
+        return self.msg
+
 class Device(QObject):
     """
-    Base device class. Opens serial communications.
+    Base device class. Opens serial communications.  All port access goes
+    through a single I/O thread owned by the device, see executor.py.  Device
+    state read by queries can be cached, see cache.py.
 
     Args:
         port (str): COM port.  Windows assumed.
+        timeout (float): default deadline for a query reply. Units (s)
+        ttl (dict): cache time-to-live per state field. Units (s)
     """
     num_devices = 0
-    def __init__(self, port = None):
+    def __init__(self, port = None, timeout=1., ttl=None):
         QObject.__init__(self)
         # Communication port must be provided or initialization will fail
         if port == None:
             raise ComError
+        self._timeout = timeout
         try:
-            self.com = serial.Serial(timeout=0, baudrate=115200)
+            # Reads block until the terminator arrives or the timeout expires.
+            # The timeout is set per read, see _read()
+            self.com = serial.Serial(timeout=timeout, baudrate=115200)
             self.com.port = port
             self.last_action = 'Port opened.'
         except serial.SerialException:
             self.last_action = 'Serial port already open.'
+        self._executor = CommandExecutor('%s I/O Thread' % (port))
+        self._cache = StateCache(ttl)
         Device.num_devices += 1
 
     def __del__(self):
@@ -41,25 +60,128 @@ class Device(QObject):
 
     def open_com(self):
         """Open the communication port"""
+        if self._executor.closed:
+            # Stopped by close_com, reopening needs a new I/O thread
+            self._executor = CommandExecutor(self._executor.name)
         self.com.open()
 
     def close_com(self):
-        """Close the communication port"""
+        """Close the communication port and stop the I/O thread"""
         self.com.close()
+        self._executor.shutdown()
+
+    ############################################################################
+    # Command scheduling.  Public read/write functions are queued on the
+    # device's I/O thread so replies from different threads cannot interleave.
 
-    def write(self, command, waittime):
+    def submit(self, fn, *args, **kwargs):
         """
-        Write serial command. Includes newline character.
+        Run a function on the device I/O thread and return a future.
+
+        Args:
+            fn (callable): function with exclusive access to the port.
+            priority (int): optional lane, USER or BACKGROUND.
+        """
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def background(self):
+        """Context for status polls.  Commands queue behind user actions."""
+        return self._executor.background()
+
+    def write(self, command, waittime=0):
+        """
+        Write serial command. Includes newline character.  Invalidates the
+        cached device state.
 
         Args:
             command (bytes): serial command string as byte type. b''
-            waittime (float): time to wait after write before read. Units (s)
+            waittime (float): optional time to wait after write. Units (s)
+        """
+        # Invalidate on both sides, so reads queued around the command
+        # cannot cache state from before it
+        self._cache.invalidate()
+        self._executor.call(self._write, command, waittime)
+        self._cache.invalidate()
+
+    def query(self, command, timeout=None):
         """
+        Write a command and return its reply as soon as it arrives.
+
+        Args:
+            command (bytes): serial command string as byte type. b''
+            timeout (float): deadline for the reply. Defaults to device timeout. Units (s)
+
+        Returns:
+            line (str): reply including the terminator.
+        """
+        return self._executor.call(self._query, command, timeout)
+
+    def query_batch(self, commands, timeout=None):
+        """
+        Write several queries in one pass and collect all replies, instead of
+        one round trip per query.
+
+        Args:
+            commands (list): serial command strings as byte type. b''
+            timeout (float): deadline for each reply. Defaults to device timeout. Units (s)
+
+        Returns:
+            lines (list): replies in command order, including terminators.
+        """
+        return self._executor.call(self._query_batch, commands, timeout)
+
+    def read(self, timeout=None):
+        """
+        Return a terminated line from the serial buffer as string.  Returns as
+        soon as the newline arrives.
+
+        Args:
+            timeout (float): deadline for the line. Defaults to device timeout. Units (s)
+        """
+        return self._executor.call(self._read, timeout)
+
+    ############################################################################
+    # Port access.  Only called from the I/O thread.
+
+    def _write(self, command, waittime=0):
+        """Write serial command, see write"""
         # Commands from sub-class devices don't need to include the newline
         # character as it is included here
         self.com.write(b'%b\n' % (command))
-        time.sleep(waittime)
+        if waittime:
+            time.sleep(waittime)
+
+    def _read(self, timeout=None):
+        """Read a terminated line, see read"""
+        if timeout is None:
+            timeout = self._timeout
+        # Setting the timeout reconfigures an open port, only do it on change
+        if self.com.timeout != timeout:
+            self.com.timeout = timeout
+        return self.com.read_until(b'\n').decode('ascii')
+
+    def _query(self, command, timeout=None):
+        """Write a command and read its reply, see query"""
+        if timeout is None:
+            timeout = self._timeout
+        # Discard stale replies, e.g. from a previous query that timed out
+        self.com.reset_input_buffer()
+        self._write(command)
+        line = self._read(timeout)
+        if not line.endswith('\n'):
+            raise ResponseError(command.decode('ascii'), timeout)
+        return line
 
-    def read(self):
-        """Return a readline from serial buffer as string"""
-        return self.com.readline().decode('ascii')
\ No newline at end of file
+    def _query_batch(self, commands, timeout=None):
+        """Pipeline queries and read their replies, see query_batch"""
+        if timeout is None:
+            timeout = self._timeout
+        self.com.reset_input_buffer()
+        self.com.write(b''.join([b'%b\n' % (command) for command in commands]))
+        lines = []
+        for command in commands:
+            line = self._read(timeout)
+            if not line.endswith('\n'):
+                raise ResponseError(command.decode('ascii'), timeout)
+            lines.append(line)
+        return lines
\ No newline at end of file
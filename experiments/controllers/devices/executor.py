@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+
+import functools
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+# Priority lanes for queued commands.  Lower values run first, so user actions
+# go ahead of background status polls waiting for the same port.
+USER = 0
+BACKGROUND = 1
+
+class ExecutorClosed(Exception):
+    """Exception for commands submitted to or left queued on a stopped executor"""
+    def __init__(self, name):
+        self.msg = '%s stopped, port closed.' % (name)
+
+    def __str__(self):
+        return self.msg
+
+class CommandExecutor(object):
+    """
+    Single owner thread for a serial port.  Commands are queued in priority
+    lanes and executed one at a time, with results handed back as futures.
+
+    Args:
+        name (str): name of the I/O thread.
+    """
+    def __init__(self, name='Device I/O Thread'):
+        self.name = name
+        self._queue = queue.PriorityQueue()
+        self._count = itertools.count() # Keeps FIFO order within a lane
+        self._local = threading.local()
+        self._lock = threading.Lock() # Orders submissions against shutdown
+        self.closed = False
+
+        self._thread = threading.Thread(name=name, target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    ############################################################################
+    # Submission
+
+    def submit(self, fn, *args, priority=None, **kwargs):
+        """
+        Queue a call for the I/O thread.
+
+        Args:
+            fn (callable): function to run with exclusive access to the port.
+            priority (int): lane, USER or BACKGROUND. Defaults to calling thread's lane.
+
+        Returns:
+            future (Future): resolves to the return value of fn.
+        """
+        future = Future()
+        if threading.current_thread() is self._thread:
+            # Already on the I/O thread, e.g. a transaction issuing queries.
+            # Queueing here would deadlock, so run in place.
+            self._execute(future, fn, args, kwargs)
+            return future
+
+        if priority is None:
+            priority = self.lane
+        with self._lock:
+            if self.closed:
+                future.set_exception(ExecutorClosed(self.name))
+            else:
+                self._queue.put((priority, next(self._count), future, fn, args, kwargs))
+        return future
+
+    def call(self, fn, *args, **kwargs):
+        """Submit a call and block until its result is available"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def shutdown(self):
+        """
+        Stop the I/O thread after the running command.  Commands still queued,
+        and any submitted later, fail with ExecutorClosed.
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            # Ahead of every lane, queued commands are failed, not run
+            self._queue.put((USER - 1, next(self._count), None, None, (), {}))
+
+    ############################################################################
+    # Priority lanes
+
+    @property
+    def lane(self):
+        """Property to return the lane used by the calling thread"""
+        return getattr(self._local, 'lane', USER)
+
+    @contextmanager
+    def background(self):
+        """Context in which the calling thread queues in the BACKGROUND lane"""
+        previous = self.lane
+        self._local.lane = BACKGROUND
+        try:
+            yield
+        finally:
+            self._local.lane = previous
+
+    ############################################################################
+    # I/O thread
+
+    def _run(self):
+        """Execute queued calls in priority order until shutdown"""
+        while 1:
+            priority, count, future, fn, args, kwargs = self._queue.get()
+            if future is None:
+                self._fail_queued()
+                break
+            if future.set_running_or_notify_cancel():
+                self._execute(future, fn, args, kwargs)
+
+    def _execute(self, future, fn, args, kwargs):
+        """Run a single call and hand its outcome to the future"""
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def _fail_queued(self):
+        """Fail the commands left in the queue at shutdown"""
+        while 1:
+            try:
+                priority, count, future, fn, args, kwargs = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if future is not None and future.set_running_or_notify_cancel():
+                future.set_exception(ExecutorClosed(self.name))
+
+def transaction(method):
+    """
+    Decorator for device methods that issue several commands which must not be
+    interleaved with commands from other threads, e.g. write then check errors.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self._executor.call(method, self, *args, **kwargs)
+    return wrapper
@@ -1,12 +1,13 @@
 #! /usr/bin/env python
 
 import time
+from collections import deque
 from .device import *
 
 class TuningError(Exception):
     """Exception for Tuning Error"""
-    def __init__(self):
-        self.msg = 'Wavelength not changed. Invalid wavelength.'
+    def __init__(self, msg='Wavelength not changed. Invalid wavelength.'):
+        self.msg = msg
 
     def __str__(self):
         return self.msg
@@ -32,11 +33,30 @@ class Insight(Device):
 
     Args:
         port (str): COM for serial communication.  This is a windows feature.
-        com_time (float): wait time to allow read/write of serial commands.
+        com_time (float): wait time after commands that return no reply.
+        timeout (float): deadline for replies to serial queries. Units (s)
+        tune_timeout (float): time allowed for the OPO to settle after a
+            wavelength change. Units (s)
+        tune_poll_time (float): interval between settle checks. Units (s)
+        ttl (dict): cache time-to-live for dsmpos, dsmmin and dsmmax
+            properties, overriding the defaults. Units (s)
     """
-    def __init__(self, port=None, com_time=0.1):
+    # DeepSee limits only change with wavelength, i.e. on command
+    _ttl = {'dsmpos': 1., 'dsmmin': 60., 'dsmmax': 60.}
+    wl_range = (680, 1300) # OPO tuning range. Units (nm)
+
+    # Telemetry queries, sent as batches
+    _hrs_queries = [b'READ:PLASer:DIODe1:HOURS?', b'READ:PLASer:DIODe2:HOURS?']
+    _stats_queries = [b'READ:PLASer:DIODe1:TEMPerature?',
+                      b'READ:PLASer:DIODe2:TEMPerature?',
+                      b'READ:HUMidity?',
+                      b'READ:PLASer:DIODe1:CURRent?',
+                      b'READ:PLASer:DIODe2:CURRent?']
+
+    def __init__(self, port=None, com_time=0.1, timeout=1., tune_timeout=10.,
+                 tune_poll_time=0.1, ttl=None):
         # Initialize serial communications with port and open that port
-        Device.__init__(self, port)
+        Device.__init__(self, port, timeout, dict(self._ttl, **(ttl or {})))
         self.open_com()
         self.fault_codes = {'000': 'Normal operation.',
             '056': 'Fault: Hardware timeout. Notify S-P if it continues.',
@@ -73,6 +93,11 @@ class Insight(Device):
         self._dsmmin = '0'
         self._dsmmax = '100'
 
+        # Wavelength settle detection and tuning durations
+        self.tune_timeout = tune_timeout
+        self.tune_poll_time = tune_poll_time
+        self._tune_times = deque(maxlen=100)
+
         # Access directly
         self.diode1_temp = ''
         self.diode2_temp = ''
@@ -82,27 +107,25 @@ class Insight(Device):
         self.diode1_hrs = ''
         self.diode2_hrs = ''
 
-        # Initialize the values where needed
-        self.write(b'WAVelength?', self._com_time)
-        self._opo_wl = int(self.read().strip())
-
-        self.write(b'CONT:DSMPOS?', self._com_time)
-        self._dsmpos = self.read().strip()
+        # Initialize the values where needed, all in one batched round trip
+        lines = self.query_batch([b'WAVelength?', b'CONT:DSMPOS?', b'CONT:SLMIN?',
+                                  b'CONT:SLMAX?'] + self._hrs_queries + self._stats_queries)
+        lines = [line.strip() for line in lines]
+        self._opo_wl = int(lines[0])
 
-        self.write(b'CONT:SLMIN?', self._com_time)
-        self._dsmmin = self.read().strip()
+        self._dsmpos, self._dsmmin, self._dsmmax = lines[1:4]
+        self._cache.set('dsmpos', self._dsmpos)
+        self._cache.set('dsmmin', self._dsmmin)
+        self._cache.set('dsmmax', self._dsmmax)
 
-        self.write(b'CONT:SLMAX?', self._com_time)
-        self._dsmmax = self.read().strip()
-
-        time.sleep(self._com_time)
-        self.laser_hrs()
-        time.sleep(self._com_time)
-        self.laser_stats()
+        self.diode1_hrs, self.diode2_hrs = lines[4:6]
+        self.diode1_temp, self.diode2_temp, self.humidity, \
+                                    self.diode1_curr, self.diode2_curr = lines[6:]
 
     ############################################################################
     # Laser on/off
 
+    @transaction
     def turnon(self):
         """Turn laser on."""
         try:
@@ -114,6 +137,7 @@ class Insight(Device):
         except Exception as e:
             self.last_action = 'Error turning on: %s' % (str(e))
 
+    @transaction
     def turnoff(self):
         """Turn laser off.  Enters hibernate mode"""
         try:
@@ -132,8 +156,10 @@ class Insight(Device):
     # flexibility in error handling
     def query_state(self):
         """Gets current state and any errors."""
-        self.write(b'*STB?', self._com_time)
-        s = int(self.read())
+        return self._parse_state(int(self.query(b'*STB?')))
+
+    def _parse_state(self, s):
+        """Store state and shutters from a status byte, and return it."""
         masked = s & 0x007F0000
         self._state = masked >> 16
         self._main_shutter = s & 0x00000004
@@ -166,8 +192,7 @@ class Insight(Device):
         # Appendix B, where the codes are explained cites the correct code:
         # 'READ:AHIS?'
         try:
-            self.write(b'READ:AHIS?', self._com_time)
-            codes = self.read().strip().split(' ')
+            codes = self.query(b'READ:AHIS?').strip().split(' ')
             string = ''
             for code in codes:
                 string += '%s: %s\n' % (code, self.fault_codes[code])
@@ -180,26 +205,15 @@ class Insight(Device):
     # Number of diode on hours
     def laser_hrs(self):
         """Reads the laser diode hours"""
-        self.write(b'READ:PLASer:DIODe1:HOURS?', self._com_time)
-        self.diode1_hrs = self.read().strip()
-        self.write(b'READ:PLASer:DIODe2:HOURS?', self._com_time)
-        self.diode2_hrs = self.read().strip()
+        lines = self.query_batch(self._hrs_queries)
+        self.diode1_hrs, self.diode2_hrs = [line.strip() for line in lines]
 
     # Temperature, humidity and diode current
     def laser_stats(self):
-        """Reads temperature, humidity and current"""
-        self.write(b'READ:PLASer:DIODe1:TEMPerature?', self._com_time)
-        self.diode1_temp = self.read().strip()
-        self.write(b'READ:PLASer:DIODe2:TEMPerature?', self._com_time)
-        self.diode2_temp = self.read().strip()
-
-        self.write(b'READ:HUMidity?', self._com_time)
-        self.humidity = self.read().strip()
-
-        self.write(b'READ:PLASer:DIODe1:CURRent?', self._com_time)
-        self.diode1_curr = self.read().strip()
-        self.write(b'READ:PLASer:DIODe2:CURRent?', self._com_time)
-        self.diode2_curr = self.read().strip()
+        """Reads temperature, humidity and current in one batched round trip"""
+        lines = self.query_batch(self._stats_queries)
+        self.diode1_temp, self.diode2_temp, self.humidity, self.diode1_curr, \
+                                self.diode2_curr = [line.strip() for line in lines]
 
     ############################################################################
     # Accessible properties for laser state OPO wavelength tuning, and shutter
@@ -235,24 +249,16 @@ class Insight(Device):
     @opo_wl.setter
     def opo_wl(self, val):
         """
-        OPO wavelength setter.  Writes to change, and reads back current wavelength
-        as well as the new DeepSee position.
+        OPO wavelength setter.  Writes to change, waits until the laser has
+        settled, and reads back current wavelength as well as the new DeepSee
+        position.
         Args:
             val (int): Wavelength, 680-1300.
         """
         try:
-            self.write(b'WAVelength %i' % (val), self._com_time + 2)
-            self.check_errors()
-            self.write(b'WAVelength?', self._com_time)
-
-            wl = int(self.read().strip())
-            if wl != val:
-                raise TuningError
-
-            self._opo_wl = wl
-            pos = self.dsmpos
-            self.last_action = 'Wavelength changed to: %i. DSM position %s' \
-                                                        % (self._opo_wl, pos)
+            t = self.tune(val)
+            self.last_action = 'Wavelength changed to: %i in %.2f s. DSM position %s' \
+                                                % (self._opo_wl, t, self._dsmpos)
         except OperationError as e:
             self.last_action = 'Operation error changing wavelength: %s' % (str(e))
         except TuningError as e:
@@ -260,6 +266,84 @@ class Insight(Device):
         except Exception as e:
             self.last_action = 'Error while changing wavelength: %s' % (str(e))
 
+    def tune(self, val, timeout=None, poll_time=None, stable=2):
+        """
+        Tune the OPO and return as soon as the laser is stable.  Settled means
+        the wavelength reads back as requested, the laser is not optimizing and
+        the DeepSee position has stopped changing, for stable consecutive
+        polls.  Errors are raised rather than logged, see opo_wl setter.
+
+        Args:
+            val (int): Wavelength, 680-1300.
+            timeout (float): time allowed to settle. Defaults to tune_timeout. Units (s)
+            poll_time (float): interval between polls. Defaults to tune_poll_time. Units (s)
+            stable (int): number of consecutive settled polls required.
+
+        Returns:
+            t (float): time taken to tune and settle. Units (s)
+        """
+        if timeout is None:
+            timeout = self.tune_timeout
+        if poll_time is None:
+            poll_time = self.tune_poll_time
+
+        # The laser ignores wavelengths out of range, fail before waiting
+        if not self.wl_range[0] <= val <= self.wl_range[1]:
+            raise TuningError('Wavelength %i out of range %i-%i.' % ((val,) + self.wl_range))
+
+        t_start = time.time()
+        self.write(b'WAVelength %i' % (val))
+        self.check_errors()
+
+        count = 0
+        wl = None
+        dsmpos = None
+        polls = 0
+        while count < stable:
+            if time.time() - t_start > timeout:
+                raise TuningError('Wavelength %i not stable after %.1f s.' % (val, timeout))
+            time.sleep(poll_time)
+
+            # Status byte, wavelength and DeepSee position in one round trip
+            lines = self.query_batch([b'*STB?', b'WAVelength?', b'CONT:DSMPOS?'])
+            self._parse_state(int(lines[0]))
+            wl = int(lines[1].strip())
+            if wl != val and polls == 0:
+                # The wavelength reads back as requested straight away, unless
+                # the command was ignored
+                raise TuningError
+            polls += 1
+            last_dsmpos = dsmpos
+            dsmpos = lines[2].strip()
+
+            optimizing = 25 < self._state < 50
+            if wl == val and not optimizing and dsmpos == last_dsmpos:
+                count += 1
+            else:
+                count = 0
+
+        self._opo_wl = wl
+        self._dsmpos = dsmpos
+        self._cache.set('dsmpos', dsmpos)
+
+        t = time.time() - t_start
+        self._tune_times.append(t)
+        return t
+
+    @property
+    def tune_stats(self):
+        """
+        Property to return timing statistics of recent wavelength changes.
+
+        Returns:
+            stats (dict): count, last, mean, min and max tuning time. Units (s)
+        """
+        times = list(self._tune_times)
+        if not times:
+            return {'count': 0, 'last': 0., 'mean': 0., 'min': 0., 'max': 0.}
+        return {'count': len(times), 'last': times[-1],
+                'mean': sum(times)/len(times), 'min': min(times), 'max': max(times)}
+
     # Shutter control
     @property
     def main_shutter(self):
@@ -267,6 +351,7 @@ class Insight(Device):
         return self._main_shutter
 
     @main_shutter.setter
+    @transaction
     def main_shutter(self, val):
         """
         Main shutter setter.  Opens or closes the shutter.
@@ -291,6 +376,7 @@ class Insight(Device):
         return self._fixed_shutter
 
     @fixed_shutter.setter
+    @transaction
     def fixed_shutter(self, val):
         """
         Fundamental shutter setter.  Opens or closes the shutter.
@@ -312,15 +398,28 @@ class Insight(Device):
     ############################################################################
     # DeepSee
 
+    # Device reads behind the cached DeepSee properties
+    def _read_dsmpos(self):
+        """Query DeepSee motor position"""
+        return self.query(b'CONT:DSMPOS?').strip()
+
+    def _read_dsmmin(self):
+        """Query DeepSee motor min position"""
+        return self.query(b'CONT:SLMIN?').strip()
+
+    def _read_dsmmax(self):
+        """Query DeepSee motor max position"""
+        return self.query(b'CONT:SLMAX?').strip()
+
     # Get current DeepSee position
     @property
     def dsmpos(self):
-        """Property to get the current DeepSee motor position"""
-        self.write(b'CONT:DSMPOS?', self._com_time)
-        self._dsmpos = self.read().strip()
+        """Property to get the current DeepSee motor position.  Cached."""
+        self._dsmpos = self._cache.fetch('dsmpos', self._read_dsmpos)
         return self._dsmpos
 
     @dsmpos.setter
+    @transaction
     def dsmpos(self, val):
         """
         DeepSee motor position setter.  Will not move beyond wavelength dependent min/max values.
@@ -331,8 +430,7 @@ class Insight(Device):
         try:
             self.write(b'CONT:DSMPOS %s' % (val), self._com_time)
             self.check_errors()
-            self.write(b'CONT:DSMPOS?', self._com_time)
-            self._dsmpos = self.read().strip()
+            self._dsmpos = self.dsmpos
             self.last_action = 'DSMPOS set to %s' % (self._dsmpos)
         except OperationError as e:
             self.last_action = 'Operation error while setting DSMPOS: %s' % (str(e))
@@ -341,14 +439,12 @@ class Insight(Device):
 
     @property
     def dsmmin(self):
-        """Return DeepSee motor min position for current wavelength."""
-        self.write(b'CONT:SLMIN?', self._com_time)
-        self._dsmmin = self.read().strip()
+        """Return DeepSee motor min position for current wavelength.  Cached."""
+        self._dsmmin = self._cache.fetch('dsmmin', self._read_dsmmin)
         return self._dsmmin
 
     @property
     def dsmmax(self):
-        """Return DeepSee motor max position for current wavelength."""
-        self.write(b'CONT:SLMAX?', self._com_time)
-        self._dsmmax = self.read().strip()
+        """Return DeepSee motor max position for current wavelength.  Cached."""
+        self._dsmmax = self._cache.fetch('dsmmax', self._read_dsmmax)
         return self._dsmmax
\ No newline at end of file
@@ -0,0 +1,344 @@
+#! /usr/bin/env python
+
+import os
+import pty
+import select
+import threading
+import time
+import tty
+import numpy as np
+
+# Simulated serial devices on pseudo-terminals, for running and benchmarking
+# the device layer without hardware.  Linux/macOS only.  Usage:
+#
+#   with SMC100Simulator() as sim:
+#       stage = DelayStage(sim.port)
+
+class SimulatedSerial(object):
+    """
+    Base class for a device simulator on a pseudo-terminal.  A thread reads
+    newline terminated commands from the master side and writes replies after
+    a response latency.  Devices open the slave side, see port.
+
+    Args:
+        latency (float): time between end of command and reply. Units (s)
+    """
+    terminator = b'\n'
+
+    def __init__(self, latency=0.002):
+        self.latency = latency
+        self.command_count = 0 # Commands received, for benchmarking
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self._running = True
+        self._thread = threading.Thread(name='%s Thread' % (type(self).__name__),
+                                        target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Stop the simulator and close the pseudo-terminal"""
+        self._running = False
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _run(self):
+        """Read commands and write replies"""
+        buf = b''
+        while self._running:
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                buf += os.read(self._master, 1024)
+            except OSError:
+                break
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                self.command_count += 1
+                reply = self.respond(line.strip().decode('ascii'))
+                if reply is not None:
+                    time.sleep(self.latency)
+                    os.write(self._master, reply.encode('ascii') + self.terminator)
+
+    def respond(self, command):
+        """Return the reply to a command, or None for no reply"""
+        return None
+
+def trapezoid(distance, vel, accel):
+    """Return peak velocity, acceleration time and cruise time of a move"""
+    ta = vel/accel
+    if accel*ta**2 > distance:
+        ta = (distance/accel)**0.5
+        vel = accel*ta
+    tc = (distance - accel*ta**2)/vel if vel else 0
+    return vel, ta, tc
+
+class SMC100Simulator(SimulatedSerial):
+    """
+    Newport SMC100 delay stage controller, address 1.  Implements the commands
+    used by DelayStage: TP, PA, PT, TS, TE, ST, VA, AC, MM and OR.  Motion
+    follows a trapezoidal velocity profile in real time.
+
+    Args:
+        pos (float): initial position. Units (mm)
+        vel (float): velocity. Units (mm/s)
+        accel (float): acceleration. Units (mm/s2)
+        latency (float): response latency. Units (s)
+    """
+    terminator = b'\r\n'
+    limits = (-100., 100.)
+
+    def __init__(self, pos=0., vel=20., accel=80., latency=0.002):
+        self.vel = vel
+        self.accel = accel
+        self.state = '32' # READY from HOMING
+        self.error = '@'
+
+        # Current move, with its profile frozen at the start: VA and AC only
+        # apply to later moves
+        self._start = pos
+        self._stop = pos
+        self._t_start = 0.
+        self._duration = 0.
+        self._profile = (0., 0., 0., accel) # v, ta, tc, accel
+        self._moving_state = '28'
+        self._done_state = '33'
+        self._lock = threading.Lock()
+        SimulatedSerial.__init__(self, latency)
+
+    ############################################################################
+    # Motion model
+
+    def _position(self, t=None):
+        """Position along the current move at time t"""
+        if t is None:
+            t = time.monotonic()
+        d = abs(self._stop - self._start)
+        v, ta, tc, a = self._profile
+        t = min(max(t - self._t_start, 0), self._duration)
+        if t < ta:
+            x = 0.5*a*t**2
+        elif t < ta + tc:
+            x = 0.5*a*ta**2 + v*(t - ta)
+        else:
+            x = d - 0.5*a*(self._duration - t)**2
+        sign = 1 if self._stop >= self._start else -1
+        return self._start + sign*x
+
+    def positions(self, t):
+        """
+        Vectorized position along the current move, e.g. to model signal that
+        depends on delay in a simulated lockin.
+
+        Args:
+            t (np array): times, from time.monotonic. Units (s)
+        """
+        with self._lock:
+            d = abs(self._stop - self._start)
+            v, ta, tc, a = self._profile
+            t = np.clip(np.asarray(t, dtype=float) - self._t_start, 0, self._duration)
+            x = np.where(t < ta, 0.5*a*t**2, 0.5*a*ta**2 + v*(t - ta))
+            x = np.where(t > ta + tc, d - 0.5*a*(self._duration - t)**2, x)
+            sign = 1 if self._stop >= self._start else -1
+            return self._start + sign*x
+
+    def _update(self):
+        """Finish the current move if its time is up"""
+        if self.state in ('28', '1E') and \
+                time.monotonic() - self._t_start >= self._duration:
+            self.state = self._done_state
+
+    def _move(self, pos, moving='28', done='33'):
+        """Start a move to an absolute position"""
+        self._start = self._position()
+        self._stop = pos
+        v, ta, tc = trapezoid(abs(pos - self._start), self.vel, self.accel)
+        self._profile = (v, ta, tc, self.accel)
+        self._duration = 2*ta + tc
+        self._t_start = time.monotonic()
+        self._moving_state = moving
+        self._done_state = done
+        self.state = moving
+
+    @property
+    def pos(self):
+        """Current position of the simulated stage"""
+        with self._lock:
+            self._update()
+            return self._position()
+
+    ############################################################################
+    # Commands
+
+    def respond(self, command):
+        with self._lock:
+            self._update()
+            if len(command) < 3 or command[0] != '1':
+                self.error = 'B'
+                return None
+            code = command[1:3].upper()
+            arg = command[3:]
+            ready = self.state in ('32', '33', '34')
+
+            if code == 'TP':
+                return '1TP%.6f' % (self._position())
+            elif code == 'TS':
+                return '1TS0000%s' % (self.state)
+            elif code == 'TE':
+                error = self.error
+                self.error = '@'
+                return '1TE%s' % (error)
+            elif code == 'PT':
+                v, ta, tc = trapezoid(abs(float(arg)), self.vel, self.accel)
+                return '1PT%.6f' % (2*ta + tc)
+            elif code in ('VA', 'AC'):
+                if arg == '?':
+                    return '1%s%.6f' % (code, self.vel if code == 'VA' else self.accel)
+                if float(arg) <= 0:
+                    self.error = 'C'
+                elif code == 'VA':
+                    self.vel = float(arg)
+                else:
+                    self.accel = float(arg)
+            elif code == 'PA':
+                pos = float(arg)
+                if not ready:
+                    self.error = 'M' if self.state == '28' else 'D'
+                elif not self.limits[0] <= pos <= self.limits[1]:
+                    self.error = 'G'
+                else:
+                    self._move(pos)
+            elif code == 'ST':
+                if self.state == '28':
+                    pos = self._position()
+                    self._start = self._stop = pos
+                    self._duration = 0.
+                    self.state = '33'
+            elif code == 'MM':
+                if arg == '0':
+                    self.state = '3C' if ready else '3D'
+                else:
+                    self.state = '34'
+            elif code == 'OR':
+                self._move(0., moving='1E', done='32')
+            else:
+                self.error = 'A'
+            return None
+
+class InsightSimulator(SimulatedSerial):
+    """
+    Spectra-Physics InSight DS+ laser.  Implements the commands used by Insight:
+    ON, OFF, WAVelength, *STB?, SHUTter, IRSHUTter, CONT:DSMPOS, CONT:SLMIN?,
+    CONT:SLMAX? and READ queries.  A wavelength change puts the laser in an
+    optimizing state for a tuning time that grows with the step size, while the
+    DeepSee motor moves to its new position.
+
+    Args:
+        wl (int): initial OPO wavelength. Units (nm)
+        on (bool): start with the laser in RUN state.
+        tune_time (float): base time for a wavelength change. Units (s)
+        tune_rate (float): additional tuning time per nm of step. Units (s/nm)
+        latency (float): response latency. Units (s)
+    """
+    def __init__(self, wl=800, on=True, tune_time=0.3, tune_rate=0.005,
+                 latency=0.005):
+        self.wl = wl
+        self.tune_time = tune_time
+        self.tune_rate = tune_rate
+        self.main_shutter = 0
+        self.fixed_shutter = 0
+        self.run_state = 50 if on else 25
+        self.history = '000'
+
+        self._dsm_start = self._dsm_target = self._dsm_for(wl)
+        self._t_tune = 0.
+        self._tune_duration = 0.
+        self._lock = threading.Lock()
+        SimulatedSerial.__init__(self, latency)
+
+    def _dsm_for(self, wl):
+        """DeepSee position for a wavelength"""
+        return 50. + 0.05*(wl - 800)
+
+    @property
+    def tuning(self):
+        """True while the simulated OPO is tuning"""
+        return time.monotonic() - self._t_tune < self._tune_duration
+
+    @property
+    def dsmpos(self):
+        """Current DeepSee position, moving linearly while tuning"""
+        if not self._tune_duration:
+            return self._dsm_target
+        f = min((time.monotonic() - self._t_tune)/self._tune_duration, 1.)
+        return self._dsm_start + f*(self._dsm_target - self._dsm_start)
+
+    @property
+    def stb(self):
+        """Status byte"""
+        state = self.run_state
+        if state == 50 and self.tuning:
+            state = 40 # Optimizing
+        s = state << 16
+        s |= 0x1 if self.run_state == 50 else 0 # Emission
+        s |= 0x4 if self.main_shutter else 0
+        s |= 0x8 if self.fixed_shutter else 0
+        return s
+
+    def respond(self, command):
+        with self._lock:
+            parts = command.split(' ')
+            cmd = parts[0].upper()
+            arg = parts[1] if len(parts) > 1 else None
+
+            if cmd == '*STB?':
+                return '%i' % (self.stb)
+            elif cmd == 'WAVELENGTH?':
+                return '%i' % (self.wl)
+            elif cmd == 'WAVELENGTH':
+                wl = int(arg)
+                if 680 <= wl <= 1300:
+                    self._dsm_start = self.dsmpos
+                    self._dsm_target = self._dsm_for(wl)
+                    self._tune_duration = self.tune_time + self.tune_rate*abs(wl - self.wl)
+                    self._t_tune = time.monotonic()
+                    self.wl = wl
+            elif cmd == 'ON':
+                self.run_state = 50
+            elif cmd == 'OFF':
+                self.run_state = 25
+            elif cmd == 'SHUTTER':
+                self.main_shutter = int(arg)
+            elif cmd == 'IRSHUTTER':
+                self.fixed_shutter = int(arg)
+            elif cmd == 'CONT:DSMPOS?':
+                return '%.2f' % (self.dsmpos)
+            elif cmd == 'CONT:DSMPOS':
+                self._dsm_start = self._dsm_target = float(arg)
+                self._tune_duration = 0.
+            elif cmd == 'CONT:SLMIN?':
+                return '%.2f' % (max(self._dsm_target - 40, 0))
+            elif cmd == 'CONT:SLMAX?':
+                return '%.2f' % (min(self._dsm_target + 40, 100))
+            elif cmd == 'READ:AHIS?':
+                return self.history
+            elif cmd.startswith('READ:PLASER:DIODE') and cmd.endswith(':HOURS?'):
+                return '1234.5'
+            elif cmd.startswith('READ:PLASER:DIODE') and cmd.endswith(':TEMPERATURE?'):
+                return '22.1'
+            elif cmd.startswith('READ:PLASER:DIODE') and cmd.endswith(':CURRENT?'):
+                return '8.2'
+            elif cmd == 'READ:HUMIDITY?':
+                return '4.5'
+            return None
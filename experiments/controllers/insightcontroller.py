@@ -18,8 +18,11 @@ class InsightController(Insight, Controller):
         com_time (float): wait time to allow read/write of serial commands.
         formset (dict/list): dictionary/list for GUI organization.
     """
+    status_period = 2
+
     def __init__(self, port, com_time, formset):
         Insight.__init__(self, port=port, com_time=com_time)
+        self._status_count = 1 # Counter to see if we should update stats or code history.
         Controller.__init__(self, formset, 'Insight DS+ Controls')
         self.set_margin(10)
 
@@ -128,12 +131,11 @@ class InsightController(Insight, Controller):
 
     def _status(self):
         """
-        Checks laser status to see if running or shutters open.  Updates stats
-        every 30s or 10 minutes
+        Checks laser status to see if running or shutters open.  Called every
+        2 s, updates stats every 30 s and code history every 10 minutes
         """
-        count = 1 # Counter to see if we should update stats or code history.
-        while 1:
-            time.sleep(2)
+        # Queue behind user commands on the shared port
+        with self.background():
             full_state = self.check_errors()
             self._state_label.value = self.state
             if self.state == 'RUN':
@@ -148,16 +150,16 @@ class InsightController(Insight, Controller):
                 self.fixed_shutter_button.label = '1040 nm Shutter Open'
                 self.fixed_shutter_button._form.setStyleSheet(self._button_on)
 
-            count += 1
-            if count % 15 == 0: # Every 30 s
+            self._status_count += 1
+            if self._status_count % 15 == 0: # Every 30 s
                 self.laser_stats()
                 self._diode1_temp_label.value = 'Diode 1 Temperature: %s' % (self.diode1_temp)
                 self._diode2_temp_label.value = 'Diode 2 Temperature: %s' % (self.diode2_temp)
                 self._diode1_curr_label.value = 'Diode 1 Current: %s' % (self.diode1_curr)
                 self._diode2_curr_label.value = 'Diode 2 Current: %s' % (self.diode2_curr)
-            elif count == 300: # Every 10 minutes
+            elif self._status_count == 300: # Every 10 minutes
                 self._update_code_history()
-                count = 1
+                self._status_count = 1
 
     def _update_code_history(self):
         """Writes the error code history"""
@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+class StatusJob(object):
+    """
+    Periodic status query registered with the StatusScheduler.
+
+    Args:
+        fn (callable): status function, called with no arguments.
+        period (float): time between calls. Units (s)
+    """
+    def __init__(self, fn, period):
+        self.fn = fn
+        self.period = period
+        self.cancelled = False
+        self.last_error = None # Last exception raised by fn, if any
+
+    def cancel(self):
+        """Stop calling the status function"""
+        self.cancelled = True
+
+class StatusScheduler(object):
+    """
+    Shared timer thread for device status queries.  Each job runs at its own
+    period, the thread sleeps until the next job is due, and all jobs can be
+    paused, e.g. during acquisitions.
+
+    Args:
+        name (str): name of the scheduler thread.
+    """
+    def __init__(self, name='Status Scheduler Thread'):
+        self._name = name
+        self._jobs = [] # Heap of (due time, count, job)
+        self._count = itertools.count()
+        self._cond = threading.Condition()
+        self._paused = 0
+        self._thread = None
+
+    ############################################################################
+    # Job registration
+
+    def register(self, fn, period, delay=None):
+        """
+        Register a status function.  Starts the scheduler thread if needed.
+
+        Args:
+            fn (callable): status function, called with no arguments.
+            period (float): time between calls. Units (s)
+            delay (float): time until the first call. Defaults to period. Units (s)
+
+        Returns:
+            job (StatusJob): handle to cancel the job.
+        """
+        job = StatusJob(fn, period)
+        if delay is None:
+            delay = period
+        with self._cond:
+            heapq.heappush(self._jobs, (time.monotonic() + delay, next(self._count), job))
+            if self._thread is None:
+                self._thread = threading.Thread(name=self._name, target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return job
+
+    ############################################################################
+    # Pausing.  Calls nest, the scheduler resumes when every pause is released.
+
+    def pause(self):
+        """Stop running status jobs.  A job already running completes."""
+        with self._cond:
+            self._paused += 1
+
+    def resume(self):
+        """Resume running status jobs"""
+        with self._cond:
+            self._paused = max(self._paused - 1, 0)
+            self._cond.notify()
+
+    @contextmanager
+    def paused(self):
+        """Context in which no status jobs run"""
+        self.pause()
+        try:
+            yield
+        finally:
+            self.resume()
+
+    @property
+    def is_paused(self):
+        """Property to return True if status jobs are paused"""
+        return self._paused > 0
+
+    ############################################################################
+    # Scheduler thread
+
+    def _next_job(self):
+        """Block until a job is due and return it"""
+        with self._cond:
+            while 1:
+                if self._paused or not self._jobs:
+                    self._cond.wait()
+                    continue
+                due, count, job = self._jobs[0]
+                if job.cancelled:
+                    heapq.heappop(self._jobs)
+                    continue
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._jobs)
+                return due, job
+
+    def _run(self):
+        """Run due jobs and reschedule them"""
+        while 1:
+            due, job = self._next_job()
+            try:
+                job.fn()
+            except Exception as e:
+                job.last_error = e
+            # Skip missed periods, e.g. after a pause, instead of catching up
+            due = max(due + job.period, time.monotonic())
+            with self._cond:
+                if not job.cancelled:
+                    heapq.heappush(self._jobs, (due, next(self._count), job))
+
+# Single scheduler shared by all controllers
+status_scheduler = StatusScheduler()
@@ -2,9 +2,17 @@
 
 import numpy as np
 import time
-import zhinst.ziPython as ziPython
 import yaml
 from AnyQt.QtCore import pyqtSignal, QObject
+from ...util.framebuffer import *
+from ...util.imager import estimate_phase, shift_rows
+from ...util.metrics import *
+from ...util.spool import *
+
+try:
+    import zhinst.ziPython as ziPython
+except ImportError:
+    ziPython = None
 
 class APIError(Exception):
     def __init__(self, error):
@@ -13,18 +21,113 @@ class APIError(Exception):
     def __str__(self):
         return self.msg
 
+class PollSession(object):
+    """
+    Demodulator polling session.  Applies the polling time constant and
+    subscribes once on open, so repeated polls cost a single server call, and
+    restores the time constant and unsubscribes on close.  Use ziDAQ.poll_session,
+    or ziDAQ._poll, which keeps a session open between polls.
+
+    Args:
+        zidaq (ziDAQ): lockin to poll.
+        tc (float): demodulator time constant with which to poll. Units (s)
+        timeout (int): timeout period for response from server. Units (ms)
+    """
+    _keys = ['x', 'y', 'auxin0', 'auxin1', 'timestamp']
+
+    def __init__(self, zidaq, tc=1e-3, timeout=500):
+        self.zidaq = zidaq
+        self.tc = tc
+        self.timeout = timeout
+        self.path = '/%s/demods/0' % (zidaq.name)
+        self.opened = False
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        """Apply the polling time constant and subscribe"""
+        server = self.zidaq.server
+        server.setDouble('%s/timeconstant' % (self.path), self.tc)
+        server.subscribe(self.path)
+        server.sync()
+        self.opened = True
+        # Rates of this session only, not totals since the last acquisition
+        self.zidaq.metrics.reset_poll()
+        return self
+
+    def close(self):
+        """Unsubscribe and restore the time constant"""
+        if not self.opened:
+            return
+        self.opened = False
+        server = self.zidaq.server
+        server.unsubscribe(self.path)
+        server.setDouble('%s/timeconstant' % (self.path), self.zidaq.tc)
+        server.sync()
+
+    def poll(self, poll_length=0.05, trim=True):
+        """
+        Poll the demodulator.  The server returns everything recorded since the
+        previous poll, e.g. during a stage move, so by default only samples from
+        the trailing poll_length are kept.
+
+        Args:
+            poll_length (float): how long to poll. Units: (s)
+            trim (bool): keep only the samples of the trailing poll_length.
+
+        Returns:
+            samples (dict): demodulator sample arrays, x, y, auxin0, auxin1 and timestamp.
+        """
+        flat_dictionary_key = True
+        t = time.monotonic()
+        data = self.zidaq.server.poll(poll_length, self.timeout, 1, flat_dictionary_key)
+        if '%s/sample' % (self.path) not in data:
+            self.zidaq.metrics.record_read(time.monotonic() - t)
+            return dict((key, np.array([])) for key in self._keys)
+
+        sample = data['%s/sample' % (self.path)]
+        samples = dict((key, np.asarray(sample[key])) for key in self._keys)
+        ts = samples['timestamp']
+        self.zidaq.metrics.record_read(time.monotonic() - t, len(ts))
+        if trim and len(ts):
+            fresh = ts >= ts[-1] - poll_length*self.zidaq.clockbase
+            samples = dict((key, val[fresh]) for key, val in samples.items())
+        return samples
+
 class ziDAQ(QObject):
     """
     Facilitates control of the ZI HFL2I lockin amplifier.  Uses the server API.
+
+    Args:
+        server (object): connected data server to use instead of discovering
+            the lockin, e.g. zisim.SimulatedServer.  Needs a device attribute.
     """
     daqData = pyqtSignal(np.ndarray)
-    def __init__(self):
+
+    # Nodes with cached values, relative to the device: attribute holding the value
+    _cached_nodes = {'demods/0/timeconstant': '_tc',
+                     'demods/0/rate': '_rate',
+                     'oscs/0/freq': '_freq'}
+
+    def __init__(self, server=None):
         QObject.__init__(self)
         self._name = ''
         self._scope = []
         self._settings = {}
 
         self._daq = None
+        self.frames = None # FrameRingBuffer of acquired frames, see start_daq
+        self.frame_capacity = 16
+        self.spool = None # FrameSpool receiving every frame, see start_daq
+        self.bidirectional_phase = None # Odd row shift, None to estimate. Units (pixels)
+        self.phase_estimate = 0. # Last estimated odd row shift. Units (pixels)
+        self._bidirectional = False
+        self.metrics = DAQMetrics() # Throughput and data loss, see util/metrics.py
+        self.status_period = 1. # Time between sample loss checks. Units (s)
 
         self._sigin = 0
         self._sigout = 0
@@ -33,10 +136,19 @@ class ziDAQ(QObject):
         self._tc = 0
         self._freq = 0
         self._rate = 0
+        self._clockbase = 210e6 # HF2 timestamp clock
+        self._requested = {} # node: (value requested, value read back)
+        self._poll_session = None # Session kept open by _poll, see close_poll
 
         try:
-            port, apilevel = self._discover()
-            self.server = ziPython.ziDAQServer('localhost', port, apilevel)
+            if server is not None:
+                self.server = server
+                self._name = server.device
+            elif ziPython is None:
+                raise ImportError('zhinst is not installed')
+            else:
+                port, apilevel = self._discover()
+                self.server = ziPython.ziDAQServer('localhost', port, apilevel)
             self.server.connect()
 
             msg = self._load_settings()
@@ -113,15 +225,40 @@ class ziDAQ(QObject):
             self._tc = self.server.getDouble('/%s/demods/0/timeconstant' % (self._name))
             self._rate = self.server.getDouble('/%s/demods/0/rate' % (self._name))
             self._freq = self.server.getDouble('/%s/oscs/0/freq' % (self._name))
+            self._clockbase = float(self.server.getInt('/%s/clockbase' % (self._name)))
         except Exception as e:
             self.last_action = str(e)
 
     ############################################################################
     # Data acquisition module for imaging
 
-    def start_daq(self, imsize, dwell, num_frames=0):
-        # imsize (rows, cols)
+    def start_daq(self, imsize, dwell, num_frames=0, bidirectional=False, spool=None):
+        """
+        Start the data acquisition module.  Completed frames are written to the
+        frames ring buffer by read_daq.  The buffer is reused while the image
+        size is unchanged.
+
+        Args:
+            imsize (tuple): image size, (rows, cols).
+            dwell (float): pixel dwell time. Units (s)
+            num_frames (int): frames to acquire, 0 for endless acquisition.
+            bidirectional (bool): scanner runs odd lines backwards.  The module
+                reverses odd rows, read_daq lines them up with even rows, see
+                bidirectional_phase.
+            spool (FrameSpool): spool to record every frame to as well, e.g.
+                for long endless acquisitions, see util/spool.py.  Spooling
+                stops when it is full.  The caller closes it.
+        """
         path = '/%s/demods/0/sample' % (self._name)
+        self.close_poll()
+        self._bidirectional = bidirectional
+        self.spool = spool
+        self.metrics.reset(num_frames)
+        self._check_status()
+        if self.frames is None or self.frames.shape != tuple(imsize):
+            self.frames = FrameRingBuffer(self.frame_capacity, imsize)
+        else:
+            self.frames.reset()
         try:
             self._daq.set(self._settings['daq'])
         except KeyError:
@@ -130,45 +267,109 @@ class ziDAQ(QObject):
                                      ['dataAcquisitionModule/triggernode', '%s.auxin1' % (path)],
                                      ['dataAcquisitionModule/edge', 1], # positive edge
                                      ['dataAcquisitionModule/level', 2.5],
-                                     ['dataAcquisitionModule/duration', dwell*imsize[1]],
                                      ['dataAcquisitionModule/delay', 0],
 
                                      ['dataAcquisitionModule/grid/mode', 2], # linear interpolation
                                      ['dataAcquisitionModule/grid/repetitions', 1],
-                                     ['dataAcquisitionModule/grid/rows', imsize[0]],
-                                     ['dataAcquisitionModule/grid/cols', imsize[1]],
-                                     ['dataAcquisitionModule/grid/direction', 0],
 
                                      ['dataAcquisitionModule/refreshrate', 200],
 
-                                     ['dataAcquisitionModule/delay', 0],
                                      ['dataAcquisitionModule/holdoff/time', 0],
                                      ['dataAcquisitionModule/holdoff/count', 0]]
-            if num_frames:
-                self._settings['daq'].append(['dataAcquisitionModule/count', num_frames])
-            else:
-                self._settings['daq'].append(['dataAcquisitionModule/endless', True])
             self._daq.set(self._settings['daq'])
         finally:
+            # Settings of this acquisition, set on every start
+            self._daq.set([['dataAcquisitionModule/duration', dwell*imsize[1]],
+                           ['dataAcquisitionModule/grid/rows', imsize[0]],
+                           ['dataAcquisitionModule/grid/cols', imsize[1]],
+                           ['dataAcquisitionModule/grid/direction', 2 if bidirectional else 0],
+                           ['dataAcquisitionModule/endless', 0 if num_frames else 1],
+                           ['dataAcquisitionModule/count', max(num_frames, 1)]])
             self._daq.subscribe('%s.r' % (path))
             self._daq.execute()
 
-    def read_daq():
-        read = '/%s/demods/0/sample' % (self._name)
+    def read_daq(self, poll_time=0.01):
+        """
+        Read completed frames into the frames ring buffer until the acquisition
+        finishes.  daqData is emitted with a copy of each frame: Qt receivers
+        keep it past the buffer slot being overwritten.  In-process consumers
+        read the buffer without copies through frames.reader().
+
+        Args:
+            poll_time (float): wait between reads with nothing new. Units (s)
+        """
+        path = '/%s/demods/0/sample.r' % (self._name)
+        last_check = time.monotonic()
         while not self._daq.finished():
-            try:
-                read = self._daq.read(True)
-                data = np.zeros([512, 512])
-                # Can return multiple frames, but right now only care about most
-                # recent
-                num_frames = len(read['%s.r' % (path)])
-                for i in range(num_frames):
-                    flags = read['%s.r' % (path)][i]['header']['flags']
-                    if flags & 1:
-                        data = np.array(read['%s.r' % (path)][i]['value'])
-                        self.daqData.emit(data)
-            except KeyError:
-                pass
+            if not self._read_frames(path):
+                time.sleep(poll_time)
+            if time.monotonic() - last_check > self.status_period:
+                self._check_status()
+                last_check = time.monotonic()
+        # Frames completed since the last read
+        self._read_frames(path)
+        self._check_status()
+        if self.spool is not None:
+            self.spool.flush()
+
+        m = self.metrics
+        if m.expected_frames and m.frames_completed < m.expected_frames:
+            self.last_action = 'Acquisition finished with %i of %i frames.' \
+                                    % (m.frames_completed, m.expected_frames)
+        elif m.data_lost:
+            self.last_action = 'Acquisition finished with data loss: %i samples, ' \
+                    '%i frames dropped.' % (m.sample_loss, m.frames_dropped)
+
+    def _read_frames(self, path):
+        """Write frames from one module read to the buffer.  Returns the count."""
+        count = 0
+        t = time.monotonic()
+        read = self._daq.read(True)
+        chunks = read.get(path, [])
+        self.metrics.record_read(time.monotonic() - t,
+                                 sum(np.size(chunk['value']) for chunk in chunks))
+        for chunk in chunks:
+            if not chunk['header']['flags'] & 1:
+                # Grid still in progress
+                self.metrics.record_frame(complete=False)
+            else:
+                value = chunk['value']
+                if self._bidirectional:
+                    value = np.array(value, dtype=float)
+                    shift = self.bidirectional_phase
+                    if shift is None:
+                        shift = self.phase_estimate = estimate_phase(value)
+                    shift_rows(value, shift)
+                if self.spool is not None:
+                    self._spool_frame(value, chunk.get('timestamp', 0))
+                seq = self.frames.write(value, chunk.get('timestamp', 0))
+                self.metrics.record_frame(dropped=seq < 0)
+                if seq >= 0:
+                    frame, timestamp = self.frames.get(seq)
+                    # Not a registered reader, the slot may be overwritten
+                    # while the receiver still holds the frame
+                    self.daqData.emit(frame.copy())
+                    count += 1
+        if chunks:
+            self.metrics.record_queue(self.frames.counters['backlog'])
+        return count
+
+    def _spool_frame(self, value, timestamp):
+        """Write a frame to the spool, spooling stops when it is full"""
+        try:
+            self.spool.write(value, timestamp)
+        except SpoolFull as e:
+            self.last_action = 'Spooling stopped: %s' % (str(e))
+            self.spool = None
+
+    def _check_status(self):
+        """Read the sample loss and ADC clipping status into the metrics"""
+        try:
+            loss = self.server.getInt('/%s/status/demodsampleloss' % (self._name))
+            clip = self.server.getInt('/%s/status/adcclip/%d' % (self._name, self._sigin))
+            self.metrics.record_status(loss, clip)
+        except Exception as e:
+            self.last_action = 'Status check failed: %s' % (str(e))
 
     @property
     def acquiring(self):
@@ -177,9 +378,33 @@ class ziDAQ(QObject):
     ############################################################################
     # Polling functions for data retrieval.
 
+    def poll_session(self, tc=1e-3, timeout=500):
+        """
+        Return a polling session, for repeated polls, e.g. one per stage position.
+
+            with zidaq.poll_session(tc) as session:
+                samples = session.poll(poll_length)
+
+        Args:
+            tc (float): demodulator time constant with which to poll. Units (s)
+            timeout (int): timeout period for response from server. Units (ms)
+        """
+        # Sessions do not nest, the subscription and time constant are shared
+        self.close_poll()
+        return PollSession(self, tc, timeout)
+
+    def close_poll(self):
+        """Close the session kept open by _poll, restoring the time constant"""
+        session, self._poll_session = self._poll_session, None
+        if session is not None:
+            session.close()
+
     def _poll(self, poll_length=0.05, timeout=500, tc=1e-3):
         """
-        Poll the demodulator and record the data.
+        Poll the demodulator and record the data.  The polling session stays
+        open between calls with the same tc and timeout, so a poll is a single
+        server call.  It is closed by close_poll, start_daq, poll_session and
+        node changes.
 
         Args:
             poll_length (float): how long to poll. Units: (s)
@@ -192,32 +417,66 @@ class ziDAQ(QObject):
             frame (np array): auxilary in 0 values.  Currently configured to olympus frame clock.
             line (np array): auxilary in 1 values. Currently configured to olympus line clock.
         """
-        flat_dictionary_key = True
-        path = '/%s/demods/0' % (self._name)
+        x = y = frame = line = np.array([])
+        try:
+            session = self._poll_session
+            if session is None or session.tc != tc or session.timeout != timeout:
+                self.close_poll()
+                session = PollSession(self, tc, timeout).open()
+                self._poll_session = session
+            samples = session.poll(poll_length)
+            x = samples['x']
+            y = samples['y']
+            frame = samples['auxin0']
+            line = samples['auxin1']
 
-        self.server.setDouble('%s/timeconstant' % (path), tc)
-        self.server.sync()
+            self.last_action = 'Polled for %f s and time constant %f s' \
+                                                            % (poll_length, tc)
+        except Exception as e:
+            self.last_action = 'While polling, encountered error: %s' % (str(e))
+            try:
+                self.close_poll()
+            except Exception:
+                self._poll_session = None
 
-        self.server.subscribe(path)
-        self.server.sync()
+        return x, y, frame, line
+
+    def _poll_samples(self, poll_length=0.05, timeout=500, tc=1e-3, trigger=None):
+        """
+        Poll the demodulator and return the raw samples with timestamps.  An
+        optional trigger is called once the subscription is active, e.g. to
+        start a delay stage move, and the device time at that moment returned.
+
+        Args:
+            poll_length (float): how long to poll. Units: (s)
+            timeout (int): timeout period for response from server. Units (ms)
+            tc (float): demodulator time constant with which to poll. Units (s)
+            trigger (callable): called just before polling starts.
+
+        Returns:
+            samples (dict): demodulator sample arrays, x, y, auxin0, auxin1 and timestamp.
+            t0 (float): device timestamp when trigger was called. Units (clockbase ticks)
+        """
+        samples = {}
+        t0 = 0
 
         try:
-            data = self.server.poll(poll_length, timeout, 1, flat_dictionary_key)
-            if '%s/sample' % (path) in data:
-                x = np.array(data['%s/sample' % (path)]['x'])
-                y = np.array(data['%s/sample' % (path)]['y'])
-                frame = np.array(data['%s/sample' % (path)]['auxin0'])
-                line = np.array(data['%s/sample' % (path)]['auxin1'])
+            with self.poll_session(tc, timeout) as session:
+                t0 = float(self.server.getInt('/%s/status/time' % (self._name)))
+                if trigger is not None:
+                    # Correct device time for time spent in the trigger call
+                    t = time.time()
+                    trigger()
+                    t0 += (time.time() - t)*self._clockbase
 
-            self.last_action = 'Polled for %f s and time constant %f s' \
+                samples = session.poll(poll_length, trim=False)
+
+            self.last_action = 'Polled samples for %f s and time constant %f s' \
                                                             % (poll_length, tc)
         except Exception as e:
             self.last_action = 'While polling, encountered error: %s' % (str(e))
 
-        self.server.setDouble('%s/timeconstant' % (path), self._tc)
-        self.server.sync()
-
-        return x, y, frame, line
+        return samples, t0
 
     def _poll_scope(self, channel):
         """Poll the oscilloscope.  Not currently in use."""
@@ -252,6 +511,60 @@ class ziDAQ(QObject):
     def name(self):
         return self._name
 
+    @property
+    def clockbase(self):
+        """Property to return the timestamp clock frequency. Units (Hz)"""
+        return self._clockbase
+
+    ############################################################################
+    # Batched node settings
+
+    def set_nodes(self, settings):
+        """
+        Set several nodes with one set call, one sync and one get to read the
+        values back.  Nodes whose cached value already matches are skipped, as
+        are nodes last set to the same value, since the device may round it.
+
+        Args:
+            settings (dict/list): {node: value} or [[node, value], ...], with
+                node paths relative to the device, e.g. 'demods/0/rate'.
+
+        Returns:
+            values (dict): values read back for the nodes that were set.
+        """
+        # An open polling session would restore its time constant over these
+        self.close_poll()
+        if isinstance(settings, dict):
+            settings = settings.items()
+
+        changed = []
+        for node, val in settings:
+            attr = self._cached_nodes.get(node)
+            if attr is not None:
+                cached = getattr(self, attr)
+                if val == cached or self._requested.get(node) == (val, cached):
+                    continue
+            changed.append([node, val])
+        if not changed:
+            return {}
+
+        self.server.set([['/%s/%s' % (self._name, node), val] for node, val in changed])
+        self.server.sync()
+
+        paths = ','.join('/%s/%s' % (self._name, node) for node, val in changed)
+        data = self.server.get(paths, flat=True)
+
+        values = {}
+        for node, val in changed:
+            path = '/%s/%s' % (self._name, node)
+            if path not in data:
+                continue
+            values[node] = data[path]['value'][0]
+            if node in self._cached_nodes:
+                setattr(self, self._cached_nodes[node], values[node])
+                self._requested[node] = (val, values[node])
+        return values
+
     ############################################################################
     # Property and setter functions for lockin time constant, modulation
     # frequency and sampling rate
@@ -270,11 +583,8 @@ class ziDAQ(QObject):
         Args:
             val (float): demodulator time constant. Units (s)
         """
-        self.server.setDouble('/%s/demods/0/timeconstant' % (self._name), val)
-        self.server.sync()
-
-        self._tc = self.server.getDouble('/%s/demods/0/timeconstant' % (self._name))
-        self.last_action = 'Lockin time constant set to %i' % (self._tc)
+        self.set_nodes({'demods/0/timeconstant': val})
+        self.last_action = 'Lockin time constant set to %g' % (self._tc)
 
     # Lockin oscillator frequency
     @property
@@ -290,10 +600,7 @@ class ziDAQ(QObject):
         Args:
             val (float): oscillator frequency. Units (Hz)
         """
-        self.server.setDouble('/%s/oscs/0/freq' % (self._name), val)
-        self.server.sync()
-
-        self._freq = self.server.getDouble('/%s/oscs/0/freq' % (self._name))
+        self.set_nodes({'oscs/0/freq': val})
         self.last_action = 'Oscillator frequency set to %i' % (self._freq)
 
     # Lockin sampling rate
@@ -310,10 +617,7 @@ class ziDAQ(QObject):
         Args:
             val (float): sampling rate of demodulated signal. Units (Sa/s)
         """
-        self.server.setDouble('/%s/demods/0/rate' % (self._name), val)
-        self.server.sync()
-
-        self._rate = self.server.getDouble('/%s/demods/0/rate' % (self._name))
+        self.set_nodes({'demods/0/rate': val})
         self.last_action = 'Lockin sampling rate set to %i' % (self._rate)
 
 
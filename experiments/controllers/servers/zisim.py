@@ -0,0 +1,297 @@
+#! /usr/bin/env python
+
+import numpy as np
+import threading
+import time
+
+# Local stand-in for the ZI data server, for running and benchmarking the
+# acquisition pipeline without an HF2LI.  Implements the subset of the
+# ziPython API used by ziDAQ.  Usage:
+#
+#   server = SimulatedServer(delay=stage_sim.positions, t0=-43.)
+#   lockin = ziDAQ(server)
+
+class SimulatedServer(object):
+    """
+    Fake ziDAQServer.  Demodulator samples are generated on demand from the
+    time elapsed since subscription, at the configured demodulator rate.
+
+    Signal model:
+        x: SRS signal, a Gaussian peak in delay stage position if delay is given,
+            modulated by a test pattern over the scanned image, plus noise.
+        y: noise.
+        auxin0: frame clock, high while the scanner is in the image, low during
+            flyback_lines of vertical flyback after each frame.
+        auxin1: line clock, high during the active line_duty of each image line.
+        With bidirectional scanning odd lines run backwards, and the scanner
+        position lags the line clock by lag in both directions.
+
+    Args:
+        device (str): device name.
+        rows (int): lines per frame of the simulated scanner.
+        line_period (float): time per line of the simulated scanner. Units (s)
+        line_duty (float): active fraction of each line, the rest is flyback.
+        flyback_lines (int): line periods of vertical flyback per frame.
+        bidirectional (bool): scan odd lines backwards.
+        lag (float): scanner position lag, fraction of a line period.
+        delay (callable): vectorized delay stage position against time.monotonic
+            times, e.g. SMC100Simulator.positions.  None for no delay dependence.
+        t0 (float): delay stage position of the SRS peak. Units (mm)
+        width (float): rms width of the SRS peak. Units (mm)
+        amplitude (float): peak signal. Units (V)
+        noise (float): rms noise. Units (V)
+        seed (int): random seed, for repeatable data.
+    """
+    clockbase = 210e6
+    clock_level = 5.
+
+    def __init__(self, device='dev0', rows=512, line_period=1e-3, line_duty=0.8,
+                 flyback_lines=2, bidirectional=False, lag=0., delay=None, t0=0.,
+                 width=0.01, amplitude=1e-3, noise=1e-5, seed=0):
+        self.device = device
+        self.rows = rows
+        self.line_period = line_period
+        self.line_duty = line_duty
+        self.flyback_lines = flyback_lines
+        self.bidirectional = bidirectional
+        self.lag = lag
+        self.delay = delay
+        self.t0 = t0
+        self.width = width
+        self.amplitude = amplitude
+        self.noise = noise
+
+        self._rng = np.random.RandomState(seed)
+        self._origin = time.monotonic()
+        self._subscribed = {} # path: time of last poll
+        self._lock = threading.Lock()
+        self._nodes = {'/%s/demods/0/timeconstant' % (device): 2e-5,
+                       '/%s/demods/0/rate' % (device): 2e5,
+                       '/%s/oscs/0/freq' % (device): 10280000.,
+                       '/%s/clockbase' % (device): self.clockbase,
+                       '/%s/status/demodsampleloss' % (device): 0}
+
+    ############################################################################
+    # Signal model
+
+    @property
+    def frame_period(self):
+        """Property to return the scanner frame period, flyback included. Units (s)"""
+        return (self.rows + self.flyback_lines)*self.line_period
+
+    def _timestamps(self, start, stop):
+        """Sample times between two time.monotonic times, at the demod rate"""
+        rate = self.getDouble('/%s/demods/0/rate' % (self.device))
+        first = np.ceil((start - self._origin)*rate)
+        last = np.floor((stop - self._origin)*rate)
+        return self._origin + np.arange(first, last)/rate
+
+    def signal(self, t):
+        """
+        Demodulator samples at times t.
+
+        Args:
+            t (np array): sample times, from time.monotonic. Units (s)
+
+        Returns:
+            samples (dict): x, y, auxin0, auxin1 and timestamp arrays.
+        """
+        t = np.asarray(t, dtype=float)
+        line = (t - self._origin)/self.line_period
+        col_phase = line % 1
+        row = np.floor(line) % (self.rows + self.flyback_lines)
+        in_frame = row < self.rows
+        in_line = in_frame & (col_phase < self.line_duty)
+
+        # Test pattern over the image, col and row from 0 to 1
+        col = (col_phase - self.lag)/self.line_duty
+        if self.bidirectional:
+            col = np.where(row % 2 == 1, 1 - col, col)
+        pattern = 1 + 0.5*np.sin(8*np.pi*col)*np.cos(8*np.pi*row/self.rows)
+        peak = 1.
+        if self.delay is not None:
+            peak = np.exp(-0.5*((self.delay(t) - self.t0)/self.width)**2)
+
+        n = len(t)
+        with self._lock:
+            noise = self._rng.normal(0, self.noise, (2, n))
+        return {'x': self.amplitude*peak*pattern/1.5 + noise[0],
+                'y': noise[1],
+                'auxin0': self.clock_level*in_frame,
+                'auxin1': self.clock_level*in_line,
+                'timestamp': ((t - self._origin)*self.clockbase).astype(np.uint64)}
+
+    ############################################################################
+    # Server API
+
+    def connect(self):
+        pass
+
+    def sync(self):
+        pass
+
+    def getLastError(self):
+        return ''
+
+    def set(self, path, value=None):
+        """Set one node, or a list of [path, value] pairs"""
+        if value is not None:
+            path = [[path, value]]
+        for node, val in path:
+            self._nodes[node] = val
+
+    def setDouble(self, path, value):
+        self._nodes[path] = float(value)
+
+    def setInt(self, path, value):
+        self._nodes[path] = int(value)
+
+    def getDouble(self, path):
+        return float(self._nodes.get(path, 0.))
+
+    def getInt(self, path):
+        if path == '/%s/status/time' % (self.device):
+            return int((time.monotonic() - self._origin)*self.clockbase)
+        return int(self._nodes.get(path, 0))
+
+    def get(self, paths, flat=True):
+        """
+        Return nodes under comma separated paths as {path: {'value': [value]}}
+        """
+        paths = paths.split(',')
+        return dict((node, {'value': [self._nodes[node]]}) for node in self._nodes
+                    if any(node.startswith(path) for path in paths))
+
+    def subscribe(self, path):
+        self._subscribed[path] = time.monotonic()
+
+    def unsubscribe(self, path):
+        self._subscribed.pop(path, None)
+
+    def poll(self, length, timeout, flags=0, flat=True):
+        """
+        Block for length seconds and return the samples of subscribed
+        demodulators since subscription or the previous poll.
+        """
+        time.sleep(length)
+        now = time.monotonic()
+        data = {}
+        for path, since in list(self._subscribed.items()):
+            self._subscribed[path] = now
+            data['%s/sample' % (path)] = self.signal(self._timestamps(since, now))
+        return data
+
+    def dataAcquisitionModule(self):
+        return SimulatedDAQModule(self)
+
+class SimulatedDAQModule(object):
+    """
+    Fake dataAcquisitionModule in grid mode.  Each trigger is the rising edge
+    of the line clock, rows lines make a grid, and completed grids are returned
+    by read.  Grid values are the subscribed signal component (x, y or r) sampled
+    at cols points over the trigger duration.
+
+    Args:
+        server (SimulatedServer): source of demodulator samples.
+    """
+    def __init__(self, server):
+        self.server = server
+        self._settings = {'grid/rows': server.rows, 'grid/cols': 512,
+                          'grid/direction': 0,
+                          'duration': server.line_duty*server.line_period,
+                          'count': 1, 'endless': False}
+        self._subscribed = []
+        self._start = None
+        self._frames_read = 0
+        self._stopped = True
+
+    def set(self, path, value=None):
+        """Set one setting, or a list of [path, value] pairs"""
+        if value is not None:
+            path = [[path, value]]
+        for setting, val in path:
+            self._settings[setting.replace('dataAcquisitionModule/', '')] = val
+
+    def get(self, path):
+        return self._settings.get(path.replace('dataAcquisitionModule/', ''))
+
+    def subscribe(self, path):
+        if path not in self._subscribed:
+            self._subscribed.append(path)
+
+    def unsubscribe(self, path):
+        if path in self._subscribed:
+            self._subscribed.remove(path)
+
+    def execute(self):
+        # Grids start on the next frame clock
+        server = self.server
+        elapsed = time.monotonic() - server._origin
+        self._start = server._origin + \
+                        np.ceil(elapsed/server.frame_period)*server.frame_period
+        self._frames_read = 0
+        self._stopped = False
+
+    def finish(self):
+        self._stopped = True
+
+    def finished(self):
+        if self._stopped:
+            return True
+        if self._settings['endless']:
+            return False
+        return self._frames_read >= self._settings['count']
+
+    def progress(self):
+        if self._settings['endless'] or self._start is None:
+            return [0.]
+        return [min(self._frames_read/float(self._settings['count']), 1.)]
+
+    def _completed(self):
+        """Number of grids completed since execute"""
+        frame_period = self.server.frame_period
+        n = int((time.monotonic() - self._start)//frame_period)
+        if not self._settings['endless']:
+            n = min(n, self._settings['count'])
+        return max(n, 0)
+
+    def _grid(self, i):
+        """Value of grid i, (rows, cols)"""
+        server = self.server
+        rows = int(self._settings['grid/rows'])
+        cols = int(self._settings['grid/cols'])
+        duration = float(self._settings['duration'])
+        lines = self._start + i*server.frame_period + np.arange(rows)*server.line_period
+        t = (lines[:, None] + np.linspace(0, duration, cols)[None, :]).ravel()
+        samples = server.signal(t)
+        return samples, lines[0], rows, cols
+
+    def read(self, flat=True):
+        """Return the grids completed since the previous read"""
+        data = {}
+        if self._start is None:
+            return data
+        completed = self._completed()
+        for i in range(self._frames_read, completed):
+            samples = None
+            for path in self._subscribed:
+                if samples is None:
+                    samples, t, rows, cols = self._grid(i)
+                component = path.split('.')[-1]
+                if component == 'r':
+                    value = np.hypot(samples['x'], samples['y'])
+                else:
+                    value = samples[component]
+                value = value.reshape(rows, cols)
+                if self._settings['grid/direction'] == 2:
+                    # Bidirectional grid, odd rows are filled in reverse
+                    value[1::2] = value[1::2, ::-1]
+                timestamp = int((t - self.server._origin)*self.server.clockbase)
+                data.setdefault(path, []).append({'header': {'flags': 1},
+                                                  'timestamp': timestamp,
+                                                  'value': value})
+        self._frames_read = completed
+        return data
+
+    def clear(self):
+        self._stopped = True
@@ -18,6 +18,8 @@ class StageController(DelayStage, Controller):
         com_time (float): wait time to allow read/write of serial commands.
         formset (dict/list): dictionary/list for GUI organization.
     """
+    status_period = 1
+
     def __init__(self, port, com_time, formset):
         DelayStage.__init__(self, port=port, com_time=com_time)
         Controller.__init__(self, formset, 'Delay Stage')
@@ -149,8 +151,8 @@ class StageController(DelayStage, Controller):
 
     def _status(self):
         """Update laser status, current position, velocity and acceleration"""
-        while 1:
-            time.sleep(1)
+        # Queue behind user commands on the shared port
+        with self.background():
             self.query_state()
             self._state_label.value = self.state
             self._pos_label.value = '%f' % (self.pos)
@@ -20,9 +20,10 @@ class ziDAQController(ziDAQ, Controller):
 
     Args:
         formset (dict/list): dictionary/list for GUI organization.
+        server (object): data server to use instead of discovering the lockin.
     """
-    def __init__(self, formset):
-        ziDAQ.__init__(self)
+    def __init__(self, formset, server=None):
+        ziDAQ.__init__(self, server)
         Controller.__init__(self, formset, 'ZI HF2LI')
         self.set_margin(10)
 
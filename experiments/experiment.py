@@ -4,6 +4,10 @@ from .controllers.zidaqcontroller import *
 from pyforms.controls import ControlButton, ControlEmptyWidget
 from .experiment import *
 from .util.data import *
+from .util.search import *
+from .util.calibration import *
+from .util.accumulator import *
+from .util.writer import *
 from multiprocessing import Queue
 import yaml
 import time
@@ -17,6 +21,12 @@ class Experiment(BaseWidget):
         calibfile (str): path to yaml file for calibration, e.g., time 0.
         logdir (str): path for working directory
     """
+    # Serial ports of the devices.  Override with simulator ports, see
+    # controllers/devices/simulator.py, to run without hardware.
+    _ports = {'insight': 'COM6', 'stage': 'COM7'}
+    # Lockin data server, None to discover the HF2LI.  See
+    # controllers/servers/zisim.py for a simulated server.
+    _zidaq_server = None
 
     def __init__(self, formset, calibfile, logdir):
         BaseWidget.__init__(self)
@@ -25,25 +35,28 @@ class Experiment(BaseWidget):
         self._logdir = logdir
 
         self._calibfile = 'calibration/t0_calibration.yaml'
-        self._calib_dict = {}
+        self._calib_dict = {'stage': {}, 'dsmpos': {}}
+        self._calib = T0Calibration(self._calib_dict)
+        self._search = CoarseToFineSearch() # Peak search for _optimize
 
         self._daq_queue = Queue()
         self._data = Data(self._logdir)
+        self._writer = AsyncWriter() # Frames are written off the acquisition thread
 
         self._insight_panel = ControlEmptyWidget(margin=10)
         self._stage_panel = ControlEmptyWidget(margin=10, side='right')
         self._zidaq_panel = ControlEmptyWidget(margin=10)
         self._expmt_panel = ControlEmptyWidget(margin=10)
 
-        self._insight = InsightController('COM6', 0.07, formset['insight'])
+        self._insight = InsightController(self._ports['insight'], 0.07, formset['insight'])
         self._insight.parent = self
         self._insight_panel.value = self._insight
 
-        self._delaystage = StageController('COM7', 0.05, formset['stage'])
+        self._delaystage = StageController(self._ports['stage'], 0.05, formset['stage'])
         self._delaystage.parent = self
         self._stage_panel.value = self._delaystage
 
-        self._zidaq = ziDAQController(formset['zidaq'])
+        self._zidaq = ziDAQController(formset['zidaq'], self._zidaq_server)
         self._zidaq.parent = self
         self._zidaq_panel.value = self._zidaq
 
@@ -79,41 +92,139 @@ class Experiment(BaseWidget):
                 for line in f:
                     tmp += line
                 self._calib_dict = yaml.load(tmp)
-            msg = 'Calibration found'
+            self._calib = T0Calibration(self._calib_dict)
+            stats = self._calib.stats()
+            msg = 'Calibration found. %i wavelengths, stage interpolation error %f mm rms' \
+                                                    % (stats['n'], stats['cv_rms'])
             self._update_history(msg)
 
         except FileNotFoundError as e:
             msg = 'No calibration found'
             self._update_history(msg)
 
+    ############################################################################
+    # Laser and delay stage orchestration
+
+    def _tune(self, wl, pos=None, settle=0):
+        """
+        Tune the OPO and move the delay stage at the same time.  The devices
+        are independent, so the stage move is started first and runs while the
+        laser tunes.  Returns once both are ready.
+
+        Args:
+            wl (int): OPO wavelength to tune to. Units (nm)
+            pos (float): delay stage position. No move if None. Units (mm)
+            settle (float): extra wait after the laser reports it has settled,
+                overlapped with the stage move. Units (s)
+        """
+        handle = None
+        if pos is not None:
+            handle = self._delaystage.move(pos, wait=False)
+
+        self._insight.opo_wl = wl
+        self._insight._update_history()
+        self._insight._main_wl_label.value = 'Main Wavelength (nm): %s' \
+                                                    % (str(self._insight.opo_wl))
+        if settle:
+            time.sleep(settle)
+
+        if handle is not None:
+            try:
+                handle.wait()
+                self._delaystage.last_action = 'Position moved to: %s' \
+                                                    % (self._delaystage._pos)
+            except Exception as e:
+                self._delaystage.last_action = 'Position not reached! %s' % (str(e))
+            self._delaystage._update_history()
+            self._delaystage._pos_label.value = '%f' % (self._delaystage._pos)
+
     ############################################################################
     # Functions for optimizing signal vs delay stage position
 
-    def _optimize(self, pos):
+    def _optimize(self, pos, strategy=None):
         """
         Optimize the lockin signal as a function of delay stage position.
         Requires laser, delay stage, and zidaq to be on, and an acquirable signal.
 
         Args:
             pos (float): a stage position around which to optimize
+            strategy (object): peak search strategy, see util/search.py.
+                Defaults to the experiment search strategy.
+
+        Returns:
+            result (SearchResult): search result, None if a stage error
+                stopped the search.
         """
-        pos_range = np.linspace(pos - .1, pos + .1, 200)
-        self._delaystage.gotopos_text.value = str(pos_range[0])
-        self._delaystage.absmov_button.click()
-
-        r = np.zeros([len(pos_range)])
-        for i, p in enumerate(pos_range):
-            print(i)
-            self._delaystage.gotopos_text.value = str(p)
-            self._delaystage.absmov_button.click()
-            time.sleep(.2)
-            x, y, frame, line = self._zidaq.poll()
-            r[i] = np.mean((x**2 + y**2)**0.5)
+        if strategy is None:
+            strategy = self._search
+
+        # One subscription for the whole search
+        with self._zidaq.poll_session() as session:
+            def measure(p):
+                # Each move returns as soon as the stage reports motion complete
+                self._delaystage.move(p)
+                samples = session.poll()
+                return np.mean((samples['x']**2 + samples['y']**2)**0.5)
+
+            # Runs in the calibrator thread, stage errors would end it silently
+            try:
+                result = strategy.search(measure, pos)
+            except PositionerError as e:
+                msg = 'Peak search stopped! Positioner Error: %s' % (str(e))
+            except CommandError as e:
+                msg = 'Peak search stopped! Command Error: %s' % (str(e))
+            except (MotionError, ResponseError, ExecutorClosed) as e:
+                msg = 'Peak search stopped! %s' % (str(e))
+            else:
+                msg = None
+        self._delaystage._pos_label.value = '%f' % (self._delaystage.pos)
+        if msg is not None:
+            self._update_history(msg)
+            return None
 
-        wl = str(self._insight.opo_wl)
+        msg = 'Peak search used %i measurements.' % (result.num_measurements)
+        if not result.bracketed:
+            msg += ' Peak at edge of search window.'
+        self._update_history(msg)
+
+        self._store_optimum(result.positions, result.values, result.peak)
+        return result
+
+    def _fly_optimize(self, pos, span=.1, duration=1., bins=200, lag=4e-3):
+        """
+        Optimize the lockin signal as a function of delay stage position with a
+        single continuous move across the window.  Demodulator samples are
+        streamed during the move and mapped to stage position from their
+        timestamps and the stage motion profile.
+
+        Args:
+            pos (float): a stage position around which to optimize. Units (mm)
+            span (float): half width of the scanned window. Units (mm)
+            duration (float): approximate time for the scan. Units (s)
+            bins (int): number of position bins for the signal trace.
+            lag (float): demodulator filter delay, ~filter order*tc. Units (s)
+        """
+        stage = self._delaystage
+        pos_range, r = fly_scan(stage, self._zidaq, pos - span, pos + span,
+                                duration, bins, lag)
+        stage._pos_label.value = '%f' % (stage.pos)
         max_pos = pos_range[np.argmax(r)]
+        self._store_optimum(pos_range, r, max_pos)
+
+    def _store_optimum(self, pos_range, r, max_pos):
+        """
+        Write the optimal stage position for the current wavelength to the
+        calibration file and save a plot of signal vs delay.
+
+        Args:
+            pos_range (np array): stage positions measured. Units (mm)
+            r (np array): demodulator amplitude at each position. Units (V)
+            max_pos (float): optimal stage position. Units (mm)
+        """
+        wl = str(self._insight.opo_wl)
         self._calib_dict['stage'][wl] = max_pos
         self._calib_dict['dsmpos'][wl] = self._insight.dsmpos
+        self._calib.fit()
 
         calib = yaml.dump(self._calib_dict)
         with open(self._calibfile, 'w') as f:
@@ -144,6 +255,8 @@ class Experiment(BaseWidget):
         logs['insight'] += '\n\n ----Beginning Code History----\n\n'
         logs['insight'] +=  self._insight.code_history
         logs['expmt'] = self._expmt_history
+        self._zidaq.close_poll()
+        self._writer.close()
         self._data.close(logs)
 
         # Write out text logs as well
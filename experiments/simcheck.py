@@ -0,0 +1,88 @@
+#! /usr/bin/env python
+
+import numpy as np
+import sys
+import time
+from .controllers.devices.simulator import SMC100Simulator, InsightSimulator
+from .controllers.devices.delaystage import DelayStage
+from .controllers.devices.insight import Insight, TuningError
+from .controllers.servers.zisim import SimulatedServer
+from .controllers.servers.zidaq import ziDAQ
+from .util.search import fly_scan
+
+# Scripted checks of the scan loops against the simulated devices, see
+# controllers/devices/simulator.py and controllers/servers/zisim.py.  Run from
+# the repository root, exits nonzero on failure:
+#
+#   python -m experiments.simcheck
+
+def check_stage_move():
+    """A move reaches its target, and a later velocity change does not move the stage"""
+    with SMC100Simulator(pos=0.) as sim:
+        stage = DelayStage(sim.port)
+        stage.pos = -1.
+        before = stage.pos
+        stage.vel = 0.2
+        after = sim.pos
+        stage.vel = 20.
+        stage.close_com()
+    return abs(before + 1.) < 1e-6 and abs(after + 1.) < 1e-6, \
+        'position %.6f, after VA %.6f, expected -1' % (before, after)
+
+def check_fly_scan(t0=-43.66, span=0.1):
+    """A fly scan finds the SRS peak of the simulated lockin"""
+    with SMC100Simulator(pos=t0 + 0.06) as sim:
+        stage = DelayStage(sim.port)
+        server = SimulatedServer(delay=sim.positions, t0=t0, rows=64, line_period=2e-4)
+        zidaq = ziDAQ(server)
+        center = t0 + 0.06
+        positions, values = fly_scan(stage, zidaq, center - span, center + span,
+                                     duration=1., bins=200, lag=0.)
+        stage.close_com()
+    peak = positions[np.argmax(values)]
+    return abs(peak - t0) < 0.005, 'peak at %.4f, expected %.4f' % (peak, t0)
+
+def check_daq_frames():
+    """The data acquisition module acquires the frames requested on every start"""
+    server = SimulatedServer(rows=64, line_period=2e-4)
+    zidaq = ziDAQ(server)
+    counts = []
+    for num_frames in (3, 5):
+        zidaq.start_daq((64, 64), 0.8*2e-4/64, num_frames)
+        zidaq.read_daq()
+        counts.append(zidaq.metrics.frames_completed)
+    return counts == [3, 5], 'frames acquired %s, expected [3, 5]' % (counts)
+
+def check_tune():
+    """Tuning settles in range, and fails fast out of range"""
+    with InsightSimulator(wl=800) as sim:
+        laser = Insight(sim.port)
+        t = laser.tune(820)
+        t_fail = time.monotonic()
+        try:
+            laser.tune(1500)
+            failed = False
+        except TuningError:
+            failed = True
+        t_fail = time.monotonic() - t_fail
+        laser.close_com()
+    return laser.opo_wl == 820 and failed and t_fail < 1., \
+        'tuned to %i in %.2f s, out of range failed %s in %.2f s' % (laser.opo_wl, t, failed, t_fail)
+
+checks = [check_stage_move, check_fly_scan, check_daq_frames, check_tune]
+
+def main():
+    failed = 0
+    for check in checks:
+        t = time.monotonic()
+        try:
+            ok, detail = check()
+        except Exception as e:
+            ok, detail = False, '%s: %s' % (type(e).__name__, str(e))
+        failed += not ok
+        print('%s %s (%.1f s): %s' % ('PASS' if ok else 'FAIL', check.__name__,
+                                      time.monotonic() - t, detail))
+    return failed
+
+if __name__ == '__main__':
+    sys.exit(main())
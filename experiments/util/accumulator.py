@@ -0,0 +1,158 @@
+import numpy as np
+
+class FrameAccumulator(object):
+    """
+    Per-pixel running statistics of a stream of frames, in constant memory.
+
+    Modes:
+        'mean': mean and variance of all frames, Welford's algorithm.
+        'ema': exponential moving average and variance with weight alpha.
+        'window': mean and variance of the last window frames.
+
+    The mean, variance, std and snr properties return internal arrays, not
+    copies.  They change as frames are added.
+
+    Args:
+        shape (tuple): frame shape, (rows, cols).
+        mode (str): accumulation mode, see above.
+        alpha (float): weight of a new frame for 'ema'.
+        window (int): number of frames for 'window'.
+        dtype (np dtype): float32 or float64 accumulators.
+    """
+    _modes = ['mean', 'ema', 'window']
+
+    def __init__(self, shape, mode='mean', alpha=0.1, window=10, dtype=np.float64):
+        if mode not in self._modes:
+            raise ValueError('Unknown accumulation mode %s' % (mode))
+        if mode == 'window' and window < 2:
+            raise ValueError('Window needs at least 2 frames')
+        self.shape = tuple(shape)
+        self.mode = mode
+        self.alpha = alpha
+        self.window = window
+        self.dtype = np.dtype(dtype)
+
+        self._mean = np.zeros(self.shape, dtype=self.dtype)
+        self._m2 = np.zeros(self.shape, dtype=self.dtype) # Sum of squared deviations
+        self._var = np.zeros(self.shape, dtype=self.dtype)
+        self._std = np.zeros(self.shape, dtype=self.dtype)
+        self._snr = np.zeros(self.shape, dtype=self.dtype)
+        self._delta = np.zeros(self.shape, dtype=self.dtype) # Scratch
+        if mode == 'window':
+            self._frames = np.zeros((window,) + self.shape, dtype=self.dtype)
+        self.count = 0
+
+    def reset(self):
+        """Forget all frames"""
+        self._mean[:] = 0
+        self._m2[:] = 0
+        self.count = 0
+
+    def add(self, frame):
+        """
+        Add a frame to the statistics.
+
+        Args:
+            frame (np array): frame of the accumulator shape.
+        """
+        if self.mode == 'ema':
+            self._add_ema(frame)
+        elif self.mode == 'window':
+            self._add_window(frame)
+        else:
+            self._add_mean(frame)
+        self.count += 1
+
+    def _add_mean(self, frame):
+        """Welford update: delta = x - mean, mean += delta/n, m2 += delta*(x - mean)"""
+        n = self.count + 1
+        np.subtract(frame, self._mean, out=self._delta)
+        self._mean += self._delta/n
+        self._delta *= frame - self._mean
+        self._m2 += self._delta
+
+    def _add_ema(self, frame):
+        """Exponentially weighted mean and variance.  m2 holds the variance."""
+        if self.count == 0:
+            self._mean[:] = frame
+            return
+        a = self.alpha
+        np.subtract(frame, self._mean, out=self._delta)
+        self._mean += a*self._delta
+        # var = (1 - a)*(var + a*delta**2)
+        self._delta **= 2
+        self._delta *= a
+        self._m2 += self._delta
+        self._m2 *= 1 - a
+
+    def _add_window(self, frame):
+        """Welford update with removal of the frame leaving the window"""
+        slot = self.count % self.window
+        if self.count >= self.window:
+            # Remove the oldest frame: the inverse of the Welford update
+            old = self._frames[slot]
+            n = self.window
+            np.subtract(old, self._mean, out=self._delta)
+            self._mean -= self._delta/(n - 1)
+            self._delta *= old - self._mean
+            self._m2 -= self._delta
+            n -= 1
+        else:
+            n = self.count
+        self._frames[slot] = frame
+        np.subtract(frame, self._mean, out=self._delta)
+        self._mean += self._delta/(n + 1)
+        self._delta *= frame - self._mean
+        self._m2 += self._delta
+
+    ############################################################################
+    # Results
+
+    @property
+    def frames(self):
+        """Property to return the number of frames in the statistics"""
+        if self.mode == 'window':
+            return min(self.count, self.window)
+        return self.count
+
+    @property
+    def effective_frames(self):
+        """Property to return the number of frames the mean effectively averages"""
+        if self.mode == 'ema':
+            return min(self.count, (2 - self.alpha)/self.alpha)
+        return self.frames
+
+    @property
+    def mean(self):
+        """Property to return the mean image"""
+        return self._mean
+
+    @property
+    def variance(self):
+        """Property to return the per-pixel variance of the frames"""
+        if self.mode == 'ema':
+            self._var[:] = self._m2
+        elif self.frames > 1:
+            np.divide(self._m2, self.frames - 1, out=self._var)
+            np.maximum(self._var, 0, out=self._var) # Rounding in window removal
+        else:
+            self._var[:] = 0
+        return self._var
+
+    @property
+    def std(self):
+        """Property to return the per-pixel standard deviation of the frames"""
+        np.sqrt(self.variance, out=self._std)
+        return self._std
+
+    @property
+    def snr(self):
+        """
+        Property to return the signal to noise ratio map of the mean image,
+        |mean|/(std/sqrt(frames)).  Zero where the std is zero.
+        """
+        std = self.std
+        err = std/np.sqrt(max(self.effective_frames, 1))
+        np.divide(np.abs(self._mean), err, out=self._snr, where=err > 0)
+        self._snr[err <= 0] = 0
+        return self._snr
@@ -0,0 +1,172 @@
+import numpy as np
+
+try:
+    from scipy.interpolate import UnivariateSpline
+except ImportError:
+    UnivariateSpline = None
+
+class CalibrationError(Exception):
+    """Exception for lookups in a calibration without enough points"""
+    def __init__(self, key):
+        self.msg = 'Not enough calibrated wavelengths for %s.' % (key)
+
+    def __str__(self):
+        return self.msg
+
+class T0Calibration(object):
+    """
+    Time zero calibration model.  Fits delay stage position and DeepSee motor
+    position against OPO wavelength from the calibrated points, so any
+    wavelength can be looked up, not only the calibrated ones.
+
+    Models (kind):
+        'linear': piecewise linear through the points, extended with the end
+            slopes outside the calibrated range.
+        'poly': least squares polynomial of degree deg.
+        'spline': cubic smoothing spline with smoothing factor s.  Needs scipy.
+
+    Args:
+        calib_dict (dict): calibration, {'stage': {wl: pos}, 'dsmpos': {wl: pos}}.
+            Shared, not copied, so updates to it are picked up by fit.
+        kind (str): model, see above.
+        deg (int): polynomial degree for 'poly'.
+        s (float): smoothing factor for 'spline'.
+    """
+    _keys = ['stage', 'dsmpos']
+
+    def __init__(self, calib_dict, kind='linear', deg=3, s=None):
+        if kind == 'spline' and UnivariateSpline is None:
+            raise ImportError('scipy is required for spline calibration models')
+        self.calib_dict = calib_dict
+        self.kind = kind
+        self.deg = deg
+        self.s = s
+
+        self._points = {}
+        self._models = {}
+        self.fit()
+
+    ############################################################################
+    # Fitting
+
+    def fit(self):
+        """(Re)fit the models from the calibration dictionary."""
+        for key in self._keys:
+            points = self.calib_dict.get(key, {})
+            wl = np.array([float(k) for k in points.keys()])
+            val = np.array([float(v) for v in points.values()])
+            order = np.argsort(wl)
+            self._points[key] = (wl[order], val[order])
+            self._models[key] = self._fit(wl[order], val[order])
+
+    def _fit(self, wl, val):
+        """Return a vectorized function for the fitted model, or None."""
+        if len(wl) < 2:
+            return None
+        if self.kind == 'poly':
+            deg = min(self.deg, len(wl) - 1)
+            # Center wavelengths for conditioning
+            center = wl.mean()
+            p = np.polyfit(wl - center, val, deg)
+            return lambda x: np.polyval(p, x - center)
+        # Cubic spline needs at least 4 points, otherwise falls back to linear
+        if self.kind == 'spline' and len(wl) > 3:
+            return UnivariateSpline(wl, val, k=3, s=self.s, ext=0)
+
+        lo = (val[1] - val[0])/(wl[1] - wl[0])
+        hi = (val[-1] - val[-2])/(wl[-1] - wl[-2])
+        def linear(x):
+            x = np.asarray(x, dtype=float)
+            y = np.interp(x, wl, val)
+            y = np.where(x < wl[0], val[0] + lo*(x - wl[0]), y)
+            return np.where(x > wl[-1], val[-1] + hi*(x - wl[-1]), y)
+        return linear
+
+    ############################################################################
+    # Lookup
+
+    def _lookup(self, key, wl):
+        """Evaluate a model.  Scalars in, scalars out."""
+        model = self._models[key]
+        if model is None:
+            raise CalibrationError(key)
+        val = model(np.asarray(wl, dtype=float))
+        if np.ndim(wl) == 0:
+            return float(val)
+        return np.asarray(val)
+
+    def stage(self, wl):
+        """
+        Delay stage position for time zero at a wavelength.
+
+        Args:
+            wl (float/np array): OPO wavelength(s). Units (nm)
+
+        Returns:
+            pos (float/np array): delay stage position(s). Units (mm)
+        """
+        return self._lookup('stage', wl)
+
+    def dsmpos(self, wl):
+        """
+        DeepSee motor position at a wavelength.
+
+        Args:
+            wl (float/np array): OPO wavelength(s). Units (nm)
+        """
+        return self._lookup('dsmpos', wl)
+
+    def in_range(self, wl):
+        """True where wavelengths are inside the calibrated range."""
+        wls = self._points['stage'][0]
+        if len(wls) == 0:
+            return np.zeros(np.shape(wl), dtype=bool)
+        return (np.asarray(wl) >= wls[0]) & (np.asarray(wl) <= wls[-1])
+
+    @property
+    def wavelengths(self):
+        """Return calibrated wavelengths, sorted."""
+        return self._points['stage'][0]
+
+    ############################################################################
+    # Residual statistics
+
+    def residuals(self, key='stage'):
+        """Return fit residuals at the calibrated points."""
+        wl, val = self._points[key]
+        if self._models[key] is None:
+            return np.zeros(len(wl))
+        return val - self._models[key](wl)
+
+    def cv_residuals(self, key='stage'):
+        """
+        Return leave-one-out residuals: each point predicted from a model fit
+        without it.  Interpolating models have no fit residual, so this is the
+        useful estimate of lookup error between calibrated wavelengths.
+        """
+        wl, val = self._points[key]
+        res = np.zeros(len(wl))
+        for i in range(len(wl)):
+            keep = np.arange(len(wl)) != i
+            model = self._fit(wl[keep], val[keep])
+            if model is not None:
+                res[i] = val[i] - model(wl[i])
+        return res
+
+    def stats(self, key='stage'):
+        """
+        Return residual statistics for a model.
+
+        Returns:
+            stats (dict): n, rms and max of fit residuals and of leave-one-out
+                residuals (cv_rms, cv_max).
+        """
+        res = self.residuals(key)
+        cv = self.cv_residuals(key)
+        stats = {'n': len(res), 'rms': 0., 'max': 0., 'cv_rms': 0., 'cv_max': 0.}
+        if len(res):
+            stats['rms'] = float(np.sqrt(np.mean(res**2)))
+            stats['max'] = float(np.max(np.abs(res)))
+            stats['cv_rms'] = float(np.sqrt(np.mean(cv**2)))
+            stats['cv_max'] = float(np.max(np.abs(cv)))
+        return stats
@@ -1,34 +1,571 @@
 import numpy as np
 import h5py
+import os
+import time
+from contextlib import contextmanager
+
+class FrameStore(object):
+    """
+    Appendable frame storage for one acquisition in an HDF5 group.  Frames go
+    into a single resizable (n, rows, cols) dataset, chunked one frame per
+    chunk, so appending a frame or reading any slice of frames touches only
+    those chunks.  Per-frame metadata is kept as parallel arrays under meta,
+    one entry per frame, acquisition metadata as attributes of the group.
+
+    With swmr the file switches to single-writer/multiple-reader mode after the
+    first write, which creates the metadata arrays.  Readers then see frames
+    as they are flushed.  No datasets or attributes can be created in SWMR
+    mode, metadata keys first seen later are skipped and kept in skipped_meta.
+
+    Layout:
+        group/frames (n, rows, cols)
+        group/meta/<key> (n,), numbers or strings
+
+    Args:
+        group (h5py.Group): empty group, or a group with a FrameStore to reopen.
+        shape (tuple): frame shape, (rows, cols).  Not needed to reopen.
+        dtype (np dtype): frame data type.
+        compression (str): None, or an HDF5 filter, e.g. 'lzf' (fast) or 'gzip'.
+        meta (dict): acquisition metadata.
+        swmr (bool): switch to SWMR mode after the first write.  The file must
+            be opened with libver='latest'.
+    """
+    def __init__(self, group, shape=None, dtype=np.float64, compression=None, meta=None,
+                 swmr=False):
+        self.group = group
+        self.swmr = swmr
+        self.skipped_meta = set()
+        if 'frames' in group:
+            self.frames = group['frames']
+        else:
+            shape = tuple(shape)
+            self.frames = group.create_dataset('frames', shape=(0,) + shape,
+                                               maxshape=(None,) + shape,
+                                               chunks=(1,) + shape, dtype=dtype,
+                                               compression=compression,
+                                               shuffle=compression is not None)
+        self.meta = group.require_group('meta')
+        if meta:
+            group.attrs.update(meta)
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    @property
+    def shape(self):
+        """Property to return the frame shape"""
+        return self.frames.shape[1:]
+
+    ############################################################################
+    # Writing
+
+    def append(self, frame, meta=None):
+        """
+        Append one frame.
+
+        Args:
+            frame (np array): frame of the store shape.
+            meta (dict): per-frame metadata, numbers or strings.
+
+        Returns:
+            index (int): index of the frame.
+        """
+        return self.extend(np.asarray(frame)[None], [meta] if meta else None)
+
+    def extend(self, frames, meta=None):
+        """
+        Append several frames with one resize and one write.
+
+        Args:
+            frames (np array): frames, (n, rows, cols).
+            meta (list): per-frame metadata dictionaries, one per frame.
+
+        Returns:
+            index (int): index of the first frame.
+        """
+        n = len(self)
+        k = len(frames)
+        self.frames.resize(n + k, axis=0)
+        self.frames[n:n + k] = frames
+
+        if meta:
+            keys = set()
+            for m in meta:
+                keys.update(m.keys())
+            for key in keys:
+                values = [m.get(key) for m in meta]
+                self._extend_meta(key, n, values)
+
+        if self.swmr and not self.group.file.swmr_mode:
+            self.group.file.swmr_mode = True
+        return n
+
+    def _extend_meta(self, key, n, values):
+        """Write per-frame values of one key for frames n onwards"""
+        if key not in self.meta:
+            if self.group.file.swmr_mode:
+                self.skipped_meta.add(key)
+                return
+            sample = next(v for v in values if v is not None)
+            if isinstance(sample, str):
+                dtype, fill = h5py.string_dtype(), ''
+            elif isinstance(sample, (int, np.integer)) and not isinstance(sample, bool):
+                dtype, fill = np.int64, 0
+            else:
+                dtype, fill = np.float64, np.nan
+            # Frames stored before the key first appeared get the fill value
+            self.meta.create_dataset(key, shape=(n,), maxshape=(None,), chunks=(1024,),
+                                     dtype=dtype, fillvalue=fill)
+        ds = self.meta[key]
+        fill = ds.fillvalue
+        if h5py.check_string_dtype(ds.dtype):
+            fill = ''
+        ds.resize(n + len(values), axis=0)
+        ds[n:] = [fill if v is None else v for v in values]
+
+    def flush(self):
+        """Flush the file to disk"""
+        self.group.file.flush()
+
+    ############################################################################
+    # Reading
+
+    def refresh(self):
+        """Update the frame count and metadata, for SWMR readers"""
+        self.frames.refresh()
+        for ds in self.meta.values():
+            ds.refresh()
+
+    def read(self, index=slice(None)):
+        """
+        Read frames.
+
+        Args:
+            index (int/slice): frame index or slice.
+        """
+        return self.frames[index]
+
+    def get_meta(self, key, index=slice(None)):
+        """Return per-frame metadata values of a key"""
+        return self.meta[key][index]
+
+def cube_chunks(shifts, shape, itemsize, target=1 << 18, max_shifts=8):
+    """
+    Return the chunk shape of a hyperspectral cube, (shifts, tile, tile).
+    Chunks span up to max_shifts shifts and a square power of 2 tile sized to
+    about target bytes, so reading one image touches (rows/tile)*(cols/tile)
+    chunks and reading one pixel spectrum shifts/max_shifts chunks.
+
+    Args:
+        shifts (int): number of Raman shifts.
+        shape (tuple): image shape, (rows, cols).
+        itemsize (int): bytes per value.
+        target (int): chunk size. Units (bytes)
+        max_shifts (int): largest number of shifts per chunk.
+    """
+    n = max(1, min(shifts, max_shifts))
+    tile = 2**int(np.log2(max(np.sqrt(target/float(n*itemsize)), 1)))
+    return (n, min(tile, shape[0]), min(tile, shape[1]))
+
+class CubeStore(object):
+    """
+    Hyperspectral cube storage for one acquisition in an HDF5 group: one image
+    per Raman shift in a (shifts, rows, cols) dataset, preallocated for a list
+    of shifts.  Per-shift coordinates are arrays attached to the first axis as
+    dimension scales, NaN until written.
+
+    Chunks span several shifts and a square tile, see cube_chunks, so both
+    image and pixel spectrum reads are fast.  Images are buffered and written
+    a chunk of shifts at a time, so chunks are written whole.  With swmr the
+    file switches to SWMR mode once everything is created, readers see images
+    as they are flushed.
+
+    Layout:
+        group/cube (shifts, rows, cols)
+        group/omega (shifts,): requested Raman shift. Units (cm-1)
+        group/omega_measured (shifts,): Raman shift from the tuned wavelength.
+            Units (cm-1)
+        group/wavelength (shifts,): OPO wavelength. Units (nm)
+        group/stage (shifts,): delay stage position. Units (mm)
+        group/time (shifts,): capture time, seconds since the epoch. Units (s)
+        group/frames (shifts,): frames averaged.
+
+    Args:
+        group (h5py.Group): empty group, or a group with a CubeStore to reopen.
+        omegas (list): Raman shifts.  Not needed to reopen. Units (cm-1)
+        shape (tuple): image shape, (rows, cols).  Not needed to reopen.
+        dtype (np dtype): image data type.
+        compression (str): None, or an HDF5 filter, e.g. 'lzf' (fast) or 'gzip'.
+        meta (dict): acquisition metadata.
+        swmr (bool): switch to SWMR mode after creation.  The file must be
+            opened with libver='latest'.
+        chunks (tuple): chunk shape, None for cube_chunks.
+    """
+    coordinates = ['omega_measured', 'wavelength', 'stage', 'time', 'frames']
+
+    def __init__(self, group, omegas=None, shape=None, dtype=np.float64, compression=None,
+                 meta=None, swmr=False, chunks=None):
+        self.group = group
+        self.swmr = swmr
+        if 'cube' in group:
+            self.cube = group['cube']
+        else:
+            n = len(omegas)
+            shape = tuple(shape)
+            if chunks is None:
+                chunks = cube_chunks(n, shape, np.dtype(dtype).itemsize)
+            self.cube = group.create_dataset('cube', shape=(n,) + shape, chunks=chunks,
+                                             dtype=dtype, compression=compression,
+                                             shuffle=compression is not None)
+            group.create_dataset('omega', data=np.asarray(omegas, dtype=float))
+            for key in self.coordinates:
+                group.create_dataset(key, shape=(n,), dtype=float, fillvalue=np.nan)
+            for dim, label in zip(self.cube.dims, ['omega', 'row', 'col']):
+                dim.label = label
+            group['omega'].make_scale('omega')
+            self.cube.dims[0].attach_scale(group['omega'])
+            for key in self.coordinates:
+                group[key].make_scale(key)
+                self.cube.dims[0].attach_scale(group[key])
+            if meta:
+                group.attrs.update(meta)
+            if swmr:
+                group.file.swmr_mode = True
+
+        self._slab = None # Chunk row of shifts being buffered
+        self._filled = []
+        self._buffer = None
+
+    def __len__(self):
+        return self.cube.shape[0]
+
+    @property
+    def shape(self):
+        """Property to return the image shape"""
+        return self.cube.shape[1:]
+
+    @property
+    def omegas(self):
+        """Property to return the Raman shifts"""
+        return self.group['omega'][:]
+
+    ############################################################################
+    # Writing
+
+    def write(self, index, image, **coords):
+        """
+        Write the image of a shift.
+
+        Args:
+            index (int): shift index.
+            image (np array): image of the cube shape.
+            coords: coordinates of the shift, see CubeStore.coordinates.
+        """
+        n = self.cube.chunks[0]
+        slab = index//n
+        if self._slab is not None and slab != self._slab:
+            self._write_slab()
+        if self._buffer is None:
+            self._buffer = np.zeros((n,) + self.shape, dtype=self.cube.dtype)
+        self._slab = slab
+        self._buffer[index - slab*n] = image
+        if index not in self._filled:
+            self._filled.append(index)
+        for key, val in coords.items():
+            self.group[key][index] = val
+        if len(self._filled) == min(n, len(self) - slab*n):
+            self._write_slab()
+
+    def _write_slab(self):
+        """Write the buffered images, runs of consecutive shifts at once"""
+        if not self._filled:
+            return
+        start = self._slab*self.cube.chunks[0]
+        filled = np.sort(self._filled)
+        runs = np.split(filled, np.flatnonzero(np.diff(filled) != 1) + 1)
+        for run in runs:
+            self.cube[run[0]:run[-1] + 1] = self._buffer[run[0] - start:run[-1] + 1 - start]
+        self._filled = []
+        self._slab = None
+
+    def flush(self):
+        """Write buffered images and flush the file to disk"""
+        self._write_slab()
+        self.group.file.flush()
+
+    ############################################################################
+    # Reading
+
+    def refresh(self):
+        """Update the images and coordinates, for SWMR readers"""
+        self.cube.refresh()
+        for key in self.coordinates:
+            self.group[key].refresh()
+
+    def image(self, index):
+        """Return the image of a shift"""
+        return self.cube[index]
+
+    def spectrum(self, row, col):
+        """Return the spectrum of a pixel, or of a region with slices"""
+        return self.cube[:, row, col]
+
+    def get_coordinate(self, key, index=slice(None)):
+        """Return per-shift values of a coordinate, see CubeStore.coordinates"""
+        return self.group[key][index]
+
+class FrameFollower(object):
+    """
+    Follows the frames of an acquisition while it is written, e.g. from an
+    analysis script or a second viewer.  Opens the acquisition file as an SWMR
+    reader, see Data.acquisition_path.
+
+    The writer holds the file exclusively until its first frame is written,
+    opening is retried until open_timeout.
+
+    Args:
+        path (str): acquisition file.
+        start (int): first frame to return.
+        poll_period (float): time between checks for new frames. Units (s)
+        open_timeout (float): longest wait for the file to open. Units (s)
+    """
+    def __init__(self, path, start=0, poll_period=0.1, open_timeout=10.):
+        self.poll_period = poll_period
+        self.next = start
+        t_end = time.monotonic() + open_timeout
+        while 1:
+            try:
+                self.file = h5py.File(path, 'r', libver='latest', swmr=True)
+                break
+            except OSError:
+                if time.monotonic() > t_end:
+                    raise
+                time.sleep(poll_period)
+        self.store = FrameStore(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def poll(self):
+        """
+        Return the frames written since the last call.
+
+        Returns:
+            start (int): index of the first new frame.
+            frames (np array): new frames, (n, rows, cols).
+        """
+        self.store.refresh()
+        start, n = self.next, len(self.store)
+        frames = self.store.read(slice(start, n))
+        self.next = max(n, start)
+        return start, frames
+
+    def follow(self, timeout=None):
+        """
+        Generator of (index, frame) as frames are written.
+
+        Args:
+            timeout (float): stop after this long without a new frame, None to
+                follow forever. Units (s)
+        """
+        last = time.monotonic()
+        while 1:
+            start, frames = self.poll()
+            for i, frame in enumerate(frames):
+                yield start + i, frame
+            if len(frames):
+                last = time.monotonic()
+            elif timeout is not None and time.monotonic() - last > timeout:
+                return
+            else:
+                time.sleep(self.poll_period)
+
+    def close(self):
+        self.file.close()
 
 class Data(object):
     """
-    Data object for handling io of data, metadata and logs.
+    Data object for handling io of data, metadata and logs.  Each acquisition
+    is a FrameStore, data/0, data/1, ... in data.h5.
+
+    With swmr each acquisition is written to its own file, acquisition_0.h5,
+    ..., in SWMR mode, and data.h5 holds external links to them.  data.h5 is
+    only opened to add links and logs, so it and finished acquisitions can be
+    read during the session, and acquisitions in progress followed with
+    FrameFollower.  Without swmr everything is in data.h5, held open until
+    close.
 
     Args:
         logdir (str): Path to working directory
+        compression (str): HDF5 filter for frames, None for no compression.
+            'lzf' is the fast option, but noisy float frames compress poorly
+            and lzf costs ~20 ms per 512x512 frame.
+        swmr (bool): one SWMR file per acquisition, see above.
 
     Attributes:
-        datafile (h5py.File): Opened hdf5 file for data storage
-        count (int): Counter for dataset storage/naming
+        path (str): Path of data.h5
+        datafile (h5py.File): Opened hdf5 file for data storage, None with swmr
+        count (int): Counter for acquisition storage/naming
     """
-    def __init__(self, logdir):
-        self.datafile = h5py.File('%s/data.h5' % (logdir), 'w')
-        self.data = h5py.create_group('data')
-
-        self.logs = h5py.create_group('logs')
+    def __init__(self, logdir, compression=None, swmr=True):
+        self.logdir = logdir
+        self.path = '%s/data.h5' % (logdir)
+        self.compression = compression
+        self.swmr = swmr
         self.count = 0
+        self._writing = {} # Acquisitions still open for writing, by index
 
-    def store_im(self, im, meta):
-        """Stores data, increments count"""
-        dataset = self.data.create_dataset('%i' % (self.count), data=im)
-        dataset.attrs.update(meta)
+        self.datafile = h5py.File(self.path, 'w')
+        self.datafile.create_group('data')
+        self.datafile.create_group('logs')
+        if swmr:
+            self.datafile.close()
+            self.datafile = None
+
+    @contextmanager
+    def _index(self):
+        """Open data.h5 for an update"""
+        if self.datafile is not None:
+            yield self.datafile
+        else:
+            with h5py.File(self.path, 'a') as f:
+                yield f
+
+    def acquisition_path(self, index):
+        """Return the file of an acquisition, data.h5 without swmr"""
+        if not self.swmr:
+            return self.path
+        return '%s/acquisition_%i.h5' % (self.logdir, index)
+
+    def new_acquisition(self, shape, meta=None, dtype=np.float64):
+        """
+        Start a new acquisition, increments count.  Finish it with
+        finish_acquisition.
+
+        Args:
+            shape (tuple): frame shape, (rows, cols).
+            meta (dict): acquisition metadata.
+            dtype (np dtype): frame data type.
+
+        Returns:
+            store (FrameStore): store to append frames to.
+        """
+        index, group = self._new_group()
+        store = FrameStore(group, shape, dtype, self.compression, meta, swmr=self.swmr)
+        return self._add_store(index, store)
+
+    def new_cube(self, omegas, shape, meta=None, dtype=np.float64, chunks=None):
+        """
+        Start a new hyperspectral cube acquisition, increments count.  Finish
+        it with finish_acquisition.
+
+        Args:
+            omegas (list): Raman shifts, one image each. Units (cm-1)
+            shape (tuple): image shape, (rows, cols).
+            meta (dict): acquisition metadata.
+            dtype (np dtype): image data type.
+            chunks (tuple): chunk shape, None for cube_chunks.
+
+        Returns:
+            cube (CubeStore): store to write images to.
+        """
+        index, group = self._new_group()
+        cube = CubeStore(group, omegas, shape, dtype, self.compression, meta,
+                         swmr=self.swmr, chunks=chunks)
+        return self._add_store(index, cube)
+
+    def _new_group(self):
+        """Return the index and group of a new acquisition, a new file with swmr"""
+        index = self.count
         self.count += 1
+        if not self.swmr:
+            return index, self.datafile['data'].create_group('%i' % (index))
+        return index, h5py.File(self.acquisition_path(index), 'w', libver='latest')
+
+    def _add_store(self, index, store):
+        """Link an SWMR acquisition file from data.h5"""
+        if not self.swmr:
+            return store
+        store.flush()
+        with self._index() as datafile:
+            # Relative links resolve from the directory of data.h5
+            path = os.path.basename(self.acquisition_path(index))
+            datafile['data/%i' % (index)] = h5py.ExternalLink(path, '/')
+        self._writing[index] = store
+        return store
+
+    def finish_acquisition(self, store, meta=None, timeout=5.):
+        """
+        Finish writing an acquisition, and add metadata only known at the end.
+        Frames queued to an AsyncWriter must be written first.
+
+        With swmr the metadata is added by reopening the acquisition file,
+        which waits for SWMR readers to close it.  After timeout it goes to
+        the attributes of meta/<index> in data.h5 instead.
+
+        Args:
+            store (FrameStore): store from new_acquisition.
+            meta (dict): acquisition metadata to add.
+            timeout (float): longest wait for readers. Units (s)
+        """
+        if not store.swmr:
+            if meta:
+                store.group.attrs.update(meta)
+            store.flush()
+            return
+        index = next(i for i, s in self._writing.items() if s is store)
+        del self._writing[index]
+        store.flush()
+        path = store.group.file.filename
+        store.group.file.close()
+        if not meta:
+            return
+
+        t_end = time.monotonic() + timeout
+        while 1:
+            try:
+                with h5py.File(path, 'a') as f:
+                    f.attrs.update(meta)
+                return
+            except OSError:
+                # File locked by a reader
+                if time.monotonic() > t_end:
+                    break
+                time.sleep(0.1)
+        with self._index() as datafile:
+            datafile.require_group('meta/%i' % (index)).attrs.update(meta)
+
+    def acquisition(self, index):
+        """Return the FrameStore, or CubeStore, of a stored acquisition"""
+        if index in self._writing:
+            return self._writing[index]
+        if not self.swmr:
+            group = self.datafile['data/%i' % (index)]
+        else:
+            group = h5py.File(self.acquisition_path(index), 'r')
+        if 'cube' in group:
+            return CubeStore(group)
+        return FrameStore(group)
+
+    def store_im(self, im, meta):
+        """Stores a single image as an acquisition of one frame"""
+        store = self.new_acquisition(np.shape(im), meta)
+        store.append(im)
+        self.finish_acquisition(store)
+        return store
 
     def close(self, logs):
-        """To be called before exit.  Stores logs, and closes file."""
-        self.logs.create_dataset('insight', data=logs['insight'])
-        self.logs.create_dataset('stage', data=logs['stage'])
-        self.logs.create_dataset('zidaq', data=logs['zidaq'])
+        """To be called before exit.  Stores logs, and closes files."""
+        for store in list(self._writing.values()):
+            self.finish_acquisition(store)
+
+        with self._index() as datafile:
+            datafile.create_dataset('logs/insight', data=logs['insight'])
+            datafile.create_dataset('logs/stage', data=logs['stage'])
+            datafile.create_dataset('logs/zidaq', data=logs['zidaq'])
 
-        self.datafile.close()
\ No newline at end of file
+        if self.datafile is not None:
+            self.datafile.close()
@@ -0,0 +1,253 @@
+import numpy as np
+import threading
+
+class BufferOverflow(Exception):
+    """Exception for writes to a full FrameRingBuffer with the 'raise' policy"""
+    def __init__(self, seq):
+        self.msg = 'Frame buffer full, frame %i not written.' % (seq)
+
+    def __str__(self):
+        return self.msg
+
+class FrameRingBuffer(object):
+    """
+    Preallocated ring buffer of image frames with sequence numbers.  One
+    producer writes frames, consumers read them through FrameReaders as views
+    into the buffer, without copying.
+
+    Overflow policies, applied when the slowest reader has not read the frame
+    about to be overwritten:
+        'overwrite': overwrite it anyway.  The reader skips ahead and counts the
+            frames it missed.  For display, where only new frames matter.
+        'drop': drop the new frame.
+        'block': wait until the reader has read it.
+        'raise': raise BufferOverflow.
+
+    Args:
+        capacity (int): number of frames.
+        shape (tuple): frame shape, (rows, cols).
+        dtype (np dtype): frame data type.
+        policy (str): overflow policy, see above.
+
+    Attributes:
+        written (int): frames written.
+        dropped (int): frames dropped by the 'drop' policy.
+        overwritten (int): frames overwritten before every reader read them.
+    """
+    _policies = ['overwrite', 'drop', 'block', 'raise']
+
+    def __init__(self, capacity, shape, dtype=np.float64, policy='overwrite'):
+        if policy not in self._policies:
+            raise ValueError('Unknown overflow policy %s' % (policy))
+        self.capacity = capacity
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.policy = policy
+
+        self._frames = np.zeros((capacity,) + self.shape, dtype=self.dtype)
+        self._seq = np.full(capacity, -1, dtype=np.int64)
+        self._timestamps = np.zeros(capacity, dtype=np.uint64)
+
+        self._next = 0 # Sequence number of the next frame written
+        self._readers = []
+        self._cond = threading.Condition()
+
+        self.written = 0
+        self.dropped = 0
+        self.overwritten = 0
+
+    ############################################################################
+    # Producer
+
+    def write(self, frame, timestamp=0, timeout=None):
+        """
+        Copy a frame into the next slot.
+
+        Args:
+            frame (np array): frame data, of the buffer shape.
+            timestamp (int): acquisition timestamp stored with the frame.
+            timeout (float): longest wait with the 'block' policy. Units (s)
+
+        Returns:
+            seq (int): sequence number of the frame, or -1 if dropped.
+        """
+        with self._cond:
+            seq = self._next
+            oldest = seq - self.capacity # Frame about to be overwritten
+            lagging = [r for r in self._readers if r.needed <= oldest]
+            if lagging:
+                if self.policy == 'drop':
+                    self.dropped += 1
+                    return -1
+                elif self.policy == 'raise':
+                    raise BufferOverflow(seq)
+                elif self.policy == 'block':
+                    ok = self._cond.wait_for(
+                        lambda: all(r.needed > oldest for r in self._readers),
+                        timeout)
+                    if not ok:
+                        self.dropped += 1
+                        return -1
+                else:
+                    self.overwritten += 1
+
+            slot = seq % self.capacity
+            self._seq[slot] = -1 # Invalid while being written
+            self._frames[slot] = frame
+            self._timestamps[slot] = timestamp
+            self._seq[slot] = seq
+            self._next += 1
+            self.written += 1
+            self._cond.notify_all()
+        return seq
+
+    ############################################################################
+    # Consumers
+
+    def reader(self, start=None):
+        """
+        Return a new reader.
+
+        Args:
+            start (int): sequence number of the first frame to read.  Defaults
+                to the next frame written.
+        """
+        with self._cond:
+            r = FrameReader(self, self._next if start is None else start)
+            self._readers.append(r)
+        return r
+
+    def _remove_reader(self, reader):
+        with self._cond:
+            if reader in self._readers:
+                self._readers.remove(reader)
+            self._cond.notify_all()
+
+    def get(self, seq):
+        """
+        Return a frame by sequence number, as a view into the buffer.
+
+        Returns:
+            frame (np array): frame view, or None if not written or overwritten.
+            timestamp (int): acquisition timestamp of the frame.
+        """
+        slot = seq % self.capacity
+        if seq < 0 or self._seq[slot] != seq:
+            return None, 0
+        return self._frames[slot], int(self._timestamps[slot])
+
+    def valid(self, seq):
+        """True if frame seq is still in the buffer, e.g. after using its view"""
+        return seq >= 0 and self._seq[seq % self.capacity] == seq
+
+    def latest(self):
+        """
+        Return the newest frame, for display.
+
+        Returns:
+            seq (int): sequence number, -1 if nothing was written.
+            frame (np array): frame view, or None.
+        """
+        seq = self._next - 1
+        frame, timestamp = self.get(seq)
+        return seq, frame
+
+    def reset(self):
+        """Forget all frames and counters.  Readers start at the next frame."""
+        with self._cond:
+            self._seq[:] = -1
+            for r in self._readers:
+                r.position = self._next
+                r.held = None
+            self.written = 0
+            self.dropped = 0
+            self.overwritten = 0
+
+    @property
+    def next_seq(self):
+        """Property to return the sequence number of the next frame written"""
+        return self._next
+
+    @property
+    def counters(self):
+        """Property to return buffer counters and reader backlog"""
+        with self._cond:
+            backlog = max([self._next - r.position for r in self._readers] or [0])
+            backlog = min(backlog, self.capacity)
+            return {'written': self.written, 'dropped': self.dropped,
+                    'overwritten': self.overwritten, 'backlog': backlog,
+                    'missed': sum(r.missed for r in self._readers)}
+
+class FrameReader(object):
+    """
+    Cursor into a FrameRingBuffer.  Frames are returned as views into the
+    buffer.  The last frame read is held until the next read or release, so
+    the 'drop', 'block' and 'raise' policies never overwrite it.  With the
+    'overwrite' policy check FrameRingBuffer.valid after using a view.
+    Use FrameRingBuffer.reader to create one.
+
+    Attributes:
+        position (int): sequence number of the next frame to read.
+        held (int): sequence number of the frame held, or None.
+        missed (int): frames overwritten before this reader got to them.
+    """
+    def __init__(self, buffer, position):
+        self.buffer = buffer
+        self.position = position
+        self.held = None
+        self.missed = 0
+
+    @property
+    def needed(self):
+        """Property to return the oldest sequence number still in use"""
+        return self.position if self.held is None else self.held
+
+    def read(self, timeout=None):
+        """
+        Return the next frame, waiting for it to be written.
+
+        Args:
+            timeout (float): longest wait, None to wait forever. Units (s)
+
+        Returns:
+            seq (int): sequence number, -1 on timeout.
+            frame (np array): frame view, or None on timeout.
+        """
+        buf = self.buffer
+        with buf._cond:
+            self.held = None
+            if not buf._cond.wait_for(lambda: buf._next > self.position, timeout):
+                buf._cond.notify_all()
+                return -1, None
+            # Skip frames already overwritten
+            oldest = buf._next - buf.capacity
+            if self.position < oldest:
+                self.missed += oldest - self.position
+                self.position = oldest
+            seq = self.position
+            self.position += 1
+            self.held = seq
+            buf._cond.notify_all()
+        frame, timestamp = buf.get(seq)
+        return seq, frame
+
+    def release(self):
+        """Release the frame held from the last read"""
+        with self.buffer._cond:
+            self.held = None
+            self.buffer._cond.notify_all()
+
+    def available(self):
+        """Number of frames written and not yet read"""
+        return self.buffer._next - self.position
+
+    def close(self):
+        """Stop reading.  The buffer no longer waits for this reader."""
+        self.buffer._remove_reader(self)
+
+    def __iter__(self):
+        """Iterate over frames available without waiting"""
+        while self.available() > 0:
+            seq, frame = self.read(0)
+            if frame is not None:
+                yield seq, frame
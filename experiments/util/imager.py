@@ -1,27 +1,213 @@
 import numpy as np
-import cv2
 import matplotlib.pyplot as plt
 import time
 
+def estimate_phase(ims):
+    """
+    Estimate the offset between even and odd lines of bidirectional images by
+    cross-correlation.  Rows are correlated in the Fourier domain, zero padded,
+    summed over all rows and frames, and the peak refined to sub-pixel
+    precision with a parabola through its neighbours.
+
+    Args:
+        ims (np array): images with odd lines already reversed, (rows, cols) or
+            (frames, rows, cols).
+
+    Returns:
+        shift (float): shift that aligns odd lines with even lines, for
+            shift_rows. Units (pixels)
+    """
+    ims = np.asarray(ims, dtype=float).reshape((-1,) + np.shape(ims)[-2:])
+    rows = min(ims[:, 0::2].shape[1], ims[:, 1::2].shape[1])
+    if rows == 0:
+        return 0.
+    even = ims[:, 0:2*rows:2]
+    odd = ims[:, 1:2*rows:2]
+    even = even - even.mean(axis=-1, keepdims=True)
+    odd = odd - odd.mean(axis=-1, keepdims=True)
+
+    n = ims.shape[-1]
+    spec = np.fft.rfft(even, 2*n)*np.conj(np.fft.rfft(odd, 2*n))
+    corr = np.fft.irfft(spec.sum(axis=(0, 1)), 2*n)
+    i = int(np.argmax(corr))
+    c0, c1, c2 = corr[i - 1], corr[i], corr[(i + 1) % (2*n)]
+    den = c0 - 2*c1 + c2
+    frac = 0.5*(c0 - c2)/den if den != 0 else 0.
+    lag = i if i < n else i - 2*n
+    # corr peaks where odd[j] matches even[j + lag], odd moves right by lag
+    return lag + frac
+
+def shift_rows(ims, shift, rows=slice(1, None, 2)):
+    """
+    Shift lines of images by a fractional number of pixels, with linear
+    interpolation and edge values held.  By default shifts odd lines.
+
+    Args:
+        ims (np array): images, (rows, cols) or (frames, rows, cols).  Changed
+            in place.
+        shift (float): shift, positive moves content to higher columns. Units (pixels)
+        rows (slice): lines to shift.
+
+    Returns:
+        ims (np array): the shifted images.
+    """
+    if shift == 0:
+        return ims
+    n = ims.shape[-1]
+    src = np.clip(np.arange(n) - shift, 0, n - 1)
+    i0 = np.minimum(np.floor(src).astype(int), max(n - 2, 0))
+    i1 = np.minimum(i0 + 1, n - 1)
+    w = src - i0
+    lines = ims[..., rows, :]
+    ims[..., rows, :] = lines[..., i0]*(1 - w) + lines[..., i1]*w
+    return ims
+
 class Imager(object):
-    def __init__(self, pixsize):
-        self.current_im = np.zeros([512, 512])
-        pass
+    """
+    Forms images from a raw demodulator stream using the scanner frame and line
+    clocks.  A frame is a high period of the frame clock and a line a high
+    period of the line clock inside it.  Each line is divided evenly into
+    pixels.  All frames completed in the stream are formed in one pass, frames
+    cut off at either end of the stream are skipped.
+
+    Pixel modes:
+        'bin': mean of the samples inside each pixel.  Pixels without samples,
+            when samples are sparser than pixels, are interpolated.
+        'interp': linear interpolation at the pixel centers.
+
+    With bidirectional scanning odd lines are reversed, and shifted by phase
+    pixels to line up with even lines.  With phase None the shift is estimated
+    from each call's frames, see estimate_phase, and kept in phase_estimate.
+
+    Args:
+        pixsize (float): pixel size. Units (um)
+        shape (tuple): image size, (rows, cols).
+        level (float): clock threshold. Units (V)
+        mode (str): pixel mode, see above.
+        bidirectional (bool): odd lines are scanned backwards.
+        phase (float): shift of odd lines, None to estimate. Units (pixels)
+    """
+    def __init__(self, pixsize=1., shape=(512, 512), level=2.5, mode='bin',
+                 bidirectional=False, phase=None):
+        self.pixsize = pixsize
+        self.shape = tuple(shape)
+        self.level = level
+        self.mode = mode
+        self.bidirectional = bidirectional
+        self.phase = phase
+        self.phase_estimate = 0.
+        self.current_im = np.zeros(self.shape)
+
+    ############################################################################
+    # Clock edges
+
+    def _intervals(self, clock):
+        """Start and stop indices of complete high periods of a clock"""
+        high = np.asarray(clock) > self.level
+        edges = np.diff(high.astype(np.int8))
+        starts = np.flatnonzero(edges == 1) + 1
+        stops = np.flatnonzero(edges == -1) + 1
+        # Drop a high period cut off at the start of the stream
+        if len(stops) and len(starts) and stops[0] <= starts[0]:
+            stops = stops[1:]
+        elif len(stops) and not len(starts):
+            stops = stops[:0]
+        n = min(len(starts), len(stops))
+        return starts[:n], stops[:n]
+
+    def _lines(self, frame, line):
+        """
+        Return line intervals with their frame and row.
+
+        Returns:
+            starts, stops (np array): sample indices of each line.
+            frame_idx (np array): frame of each line, from 0.
+            row_idx (np array): row of each line in its frame.
+            num_frames (int): number of complete frames.
+        """
+        fstarts, fstops = self._intervals(frame)
+        lstarts, lstops = self._intervals(line)
+
+        # Frame of each line, lines outside a complete frame are dropped
+        k = np.searchsorted(fstarts, lstarts, side='right') - 1
+        inside = k >= 0
+        inside[inside] &= lstops[inside] <= fstops[k[inside]]
+        lstarts, lstops, k = lstarts[inside], lstops[inside], k[inside]
+
+        # Row of each line: position in the run of lines with the same frame
+        first = np.searchsorted(k, k, side='left')
+        rows = np.arange(len(k)) - first
+        keep = rows < self.shape[0]
+        return lstarts[keep], lstops[keep], k[keep], rows[keep], len(fstarts)
+
+    ############################################################################
+    # Image formation
+
+    def _pixels(self, r, starts, stops):
+        """Pixel values of each line, (lines, cols)"""
+        cols = self.shape[1]
+        r = np.asarray(r, dtype=float)
+        # Fractional sample positions of pixel edges along each line
+        edges = starts[:, None] + (stops - starts)[:, None]*np.arange(cols + 1)/float(cols)
+        centers = 0.5*(edges[:, 1:] + edges[:, :-1])
+        if self.mode == 'interp':
+            return np.interp(centers, np.arange(len(r)), r)
+
+        # Bin sums from the cumulative sum, one subtraction per pixel
+        idx = np.ceil(edges).astype(np.int64)
+        csum = np.concatenate([[0.], np.cumsum(r)])
+        sums = csum[idx[:, 1:]] - csum[idx[:, :-1]]
+        counts = idx[:, 1:] - idx[:, :-1]
+        values = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+        empty = counts == 0
+        if empty.any():
+            values[empty] = np.interp(centers[empty], np.arange(len(r)), r)
+        return values
 
-    # Create image from zidaq output
-    # Requires info from frame and line input on the scanning
     def form_image(self, r, frame, line):
-        iframeon = np.where(frame[:-1]+1 < frame[1:]) + 1
-        ilineon = np.where(line[:-1]+1 < line[1:]) + 1
-        ilineoff = np.where(line[:-1]+1 > line[1:]) + 1
-        lines = [(on, off) for on, off in ilineon, ilineoff]
+        """
+        Form the complete frames in a raw stream.
+
+        Args:
+            r (np array): demodulator amplitude samples.
+            frame (np array): frame clock samples, e.g. auxin0. Units (V)
+            line (np array): line clock samples, e.g. auxin1. Units (V)
+
+        Returns:
+            ims (np array): complete frames, (frames, rows, cols).  Rows without
+                a line are zero.
+        """
+        starts, stops, k, rows, num_frames = self._lines(frame, line)
+        ims = np.zeros((num_frames,) + self.shape)
+        if len(starts):
+            ims[k, rows] = self._pixels(r, starts, stops)
+        if num_frames and self.bidirectional:
+            self._correct_bidirectional(ims)
+        if num_frames:
+            self.current_im = ims[-1]
+        return ims
+
+    def _correct_bidirectional(self, ims):
+        """Reverse odd lines and line them up with even lines, in place"""
+        ims[:, 1::2] = ims[:, 1::2, ::-1]
+        shift = self.phase
+        if shift is None:
+            shift = self.phase_estimate = estimate_phase(ims)
+        shift_rows(ims, shift)
+
+    def form_samples(self, samples):
+        """
+        Form the complete frames in polled demodulator samples.
 
-        im = np.zeros([512, 512])
-        for i, l in enumerate(lines):
-            im[i] = cv2.resize(np.array(r[l[0]:l[1], ndmin=2, dtype=float), dsize=(512,1))
+        Args:
+            samples (dict): sample arrays x, y, auxin0 and auxin1, e.g. from
+                ziDAQ.poll_session.
 
-        self.current_im = im
-        return im
+        Returns:
+            ims (np array): complete frames, (frames, rows, cols).
+        """
+        r = np.hypot(samples['x'], samples['y'])
+        return self.form_image(r, samples['auxin0'], samples['auxin1'])
 
     # Display current image
     def display(self):
@@ -29,4 +215,4 @@ class Imager(object):
             time.sleep(1)
             plt.cla()
             plt.clf()
-            plt.imshow(self.current_im)
\ No newline at end of file
+            plt.imshow(self.current_im)
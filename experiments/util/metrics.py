@@ -0,0 +1,157 @@
+import threading
+import time
+
+class DAQMetrics(object):
+    """
+    Throughput and data loss counters for the lockin data path.  Updated by
+    the reading thread, readable live with snapshot.
+
+    Attributes:
+        expected_frames (int): frames requested, 0 for endless acquisition.
+        samples (int): demodulator samples or grid points received.
+        frames_completed (int): complete grids received.
+        frames_partial (int): chunks received without the grid complete flag.
+        frames_dropped (int): complete grids dropped by the frame buffer.
+        reads (int): read or poll calls.
+        sample_loss (int): samples lost, from /status/demodsampleloss.
+        loss_events (list): (time since start, samples lost) for each increase
+            of the sample loss counter. Units (s)
+        adc_clip (int): status checks that found the ADC clipping.
+        queue_depth (int): frames waiting in the frame buffer at the last read.
+        queue_max (int): largest queue depth seen.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, expected_frames=0):
+        """
+        Clear all counters, e.g. at the start of an acquisition.
+
+        Args:
+            expected_frames (int): frames requested, 0 for endless acquisition.
+        """
+        with self._lock:
+            self.expected_frames = expected_frames
+            self.frames_completed = 0
+            self.frames_partial = 0
+            self.frames_dropped = 0
+            self._reset_reads()
+
+            self.sample_loss = 0
+            self.loss_events = []
+            self.adc_clip = 0
+            self._last_loss = None
+
+            self.queue_depth = 0
+            self.queue_max = 0
+
+    def reset_poll(self):
+        """
+        Clear the read and sample counters and restart the clock, e.g. when a
+        polling session opens.  Frame and status counters are kept.
+        """
+        with self._lock:
+            self._reset_reads()
+
+    def _reset_reads(self):
+        self.t_start = time.monotonic()
+        self.samples = 0
+        self.reads = 0
+        self.read_time = 0.
+        self.read_max = 0.
+        self.read_last = 0.
+
+    ############################################################################
+    # Recording, called from the reading thread
+
+    def record_read(self, latency, samples=0):
+        """
+        Record a read or poll call.
+
+        Args:
+            latency (float): duration of the call. Units (s)
+            samples (int): samples or grid points returned.
+        """
+        with self._lock:
+            self.reads += 1
+            self.read_time += latency
+            self.read_last = latency
+            self.read_max = max(self.read_max, latency)
+            self.samples += samples
+
+    def record_frame(self, complete=True, dropped=False):
+        """Record a grid chunk: complete or partial, and dropped by the buffer"""
+        with self._lock:
+            if not complete:
+                self.frames_partial += 1
+                return
+            self.frames_completed += 1
+            if dropped:
+                self.frames_dropped += 1
+
+    def record_queue(self, depth):
+        """Record the frame buffer backlog"""
+        with self._lock:
+            self.queue_depth = depth
+            self.queue_max = max(self.queue_max, depth)
+
+    def record_status(self, sample_loss, adc_clip):
+        """
+        Record the device status.  The first call after reset is the baseline
+        for the sample loss counter.
+
+        Args:
+            sample_loss (int): /status/demodsampleloss value.
+            adc_clip (int): /status/adcclip value, nonzero while clipping.
+        """
+        with self._lock:
+            if self._last_loss is not None and sample_loss != self._last_loss:
+                # Counter reset by the device if it went down
+                lost = sample_loss - self._last_loss
+                if lost < 0:
+                    lost = sample_loss
+                if lost > 0:
+                    self.sample_loss += lost
+                    self.loss_events.append((time.monotonic() - self.t_start, lost))
+            self._last_loss = sample_loss
+            if adc_clip:
+                self.adc_clip += 1
+
+    ############################################################################
+    # Reading
+
+    @property
+    def elapsed(self):
+        """Property to return time since reset. Units (s)"""
+        return time.monotonic() - self.t_start
+
+    @property
+    def data_lost(self):
+        """Property to return True if samples or frames were lost"""
+        return self.sample_loss > 0 or self.frames_dropped > 0
+
+    def snapshot(self):
+        """
+        Return the counters and derived rates as a flat dictionary of numbers,
+        e.g. for display or for storage with the acquired data.
+        """
+        with self._lock:
+            elapsed = max(time.monotonic() - self.t_start, 1e-9)
+            return {'elapsed': elapsed,
+                    'samples': self.samples,
+                    'samples_per_s': self.samples/elapsed,
+                    'frames_expected': self.expected_frames,
+                    'frames_completed': self.frames_completed,
+                    'frames_partial': self.frames_partial,
+                    'frames_dropped': self.frames_dropped,
+                    'frames_per_s': self.frames_completed/elapsed,
+                    'reads': self.reads,
+                    'read_mean': self.read_time/self.reads if self.reads else 0.,
+                    'read_max': self.read_max,
+                    'read_last': self.read_last,
+                    'sample_loss': self.sample_loss,
+                    'loss_events': len(self.loss_events),
+                    'adc_clip': self.adc_clip,
+                    'queue_depth': self.queue_depth,
+                    'queue_max': self.queue_max}
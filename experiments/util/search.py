@@ -0,0 +1,215 @@
+import numpy as np
+
+# Strategies for locating the delay stage position of maximum signal.  Each
+# strategy has a search(measure, center) function, where measure(pos) moves
+# the stage, measures and returns the signal at that position.
+
+class SearchResult(object):
+    """
+    Outcome of a peak search.
+
+    Attributes:
+        peak (float): estimated position of maximum signal. Units (mm)
+        positions (np array): positions measured, in measurement order. Units (mm)
+        values (np array): signal measured at each position.
+        num_measurements (int): number of measurements used.
+        bracketed (bool): False if the maximum was at the edge of the window.
+    """
+    def __init__(self, peak, positions, values, bracketed=True):
+        self.peak = peak
+        self.positions = np.array(positions)
+        self.values = np.array(values)
+        self.num_measurements = len(positions)
+        self.bracketed = bracketed
+
+class GridSearch(object):
+    """
+    Measure on a fixed grid and take the maximum.
+
+    Args:
+        span (float): half width of the search window. Units (mm)
+        points (int): number of grid points.
+    """
+    def __init__(self, span=.1, points=200):
+        self.span = span
+        self.points = points
+
+    def search(self, measure, center):
+        """
+        Args:
+            measure (callable): returns signal at a stage position.
+            center (float): center of the search window. Units (mm)
+
+        Returns:
+            result (SearchResult): peak estimate and measurements.
+        """
+        positions = np.linspace(center - self.span, center + self.span, self.points)
+        values = [measure(p) for p in positions]
+        i = np.argmax(values)
+        return SearchResult(positions[i], positions, values,
+                            bracketed=0 < i < len(positions) - 1)
+
+class CoarseToFineSearch(object):
+    """
+    Coarse grid to bracket the peak, then refine inside the bracket until the
+    position is known to within a tolerance.
+
+    Refinement methods:
+        'parabolic': successive parabolic interpolation through the best three
+            points, with golden-section steps when the parabola is unusable.
+        'golden': golden-section search.
+        'gaussian': Gaussian fit (parabola in log signal) to the coarse points
+            above half maximum.  One extra measurement at the fitted peak.
+
+    Args:
+        span (float): half width of the search window. Units (mm)
+        points (int): number of coarse grid points.
+        tol (float): position tolerance at which refinement stops. Units (mm)
+        refine (str): refinement method, see above.
+        max_measurements (int): upper bound on measurements, coarse included.
+    """
+    _golden = 0.5*(3 - 5**0.5)
+
+    def __init__(self, span=.1, points=11, tol=1e-3, refine='parabolic',
+                 max_measurements=40):
+        self.span = span
+        self.points = points
+        self.tol = tol
+        self.refine = refine
+        self.max_measurements = max_measurements
+
+    def search(self, measure, center):
+        """
+        Args:
+            measure (callable): returns signal at a stage position.
+            center (float): center of the search window. Units (mm)
+
+        Returns:
+            result (SearchResult): peak estimate and measurements.
+        """
+        grid = np.linspace(center - self.span, center + self.span, self.points)
+        positions = list(grid)
+        values = [measure(p) for p in grid]
+
+        i = int(np.argmax(values))
+        if i == 0 or i == len(grid) - 1:
+            # Peak not bracketed, nothing to refine
+            return SearchResult(grid[i], positions, values, bracketed=False)
+
+        if self.refine == 'gaussian':
+            peak = self._gaussian_peak(grid, np.array(values), i)
+            positions.append(peak)
+            values.append(measure(peak))
+        else:
+            peak = self._refine(measure, grid[i-1:i+2], values[i-1:i+2],
+                                positions, values)
+        return SearchResult(peak, positions, values)
+
+    def _refine(self, measure, x, f, positions, values):
+        """
+        Shrink the bracket a < b < c, f(b) >= f(a), f(c), around the maximum.
+        Measurements are appended to positions and values.
+        """
+        a, b, c = x
+        fa, fb, fc = f
+        while c - a > self.tol and len(positions) < self.max_measurements:
+            u = None
+            if self.refine == 'parabolic':
+                den = (b - a)*(fb - fc) - (b - c)*(fb - fa)
+                if den != 0:
+                    u = b - 0.5*((b - a)**2*(fb - fc) - (b - c)**2*(fb - fa))/den
+                    # Reject vertices outside the bracket or too close to b
+                    if not (a < u < c) or np.abs(u - b) < 0.25*self.tol:
+                        u = None
+            if u is None:
+                # Golden-section step into the larger interval
+                if c - b > b - a:
+                    u = b + self._golden*(c - b)
+                else:
+                    u = b - self._golden*(b - a)
+
+            fu = measure(u)
+            positions.append(u)
+            values.append(fu)
+            if fu > fb:
+                if u < b:
+                    c, fc = b, fb
+                else:
+                    a, fa = b, fb
+                b, fb = u, fu
+            else:
+                if u < b:
+                    a, fa = u, fu
+                else:
+                    c, fc = u, fu
+        return b
+
+    def _gaussian_peak(self, x, f, i):
+        """Peak of a parabola fit to log signal for points above half maximum."""
+        above = f > 0.5*f[i]
+        # Contiguous run of points above half maximum around the maximum
+        lo = i
+        while lo > 0 and above[lo - 1]:
+            lo -= 1
+        hi = i
+        while hi < len(f) - 1 and above[hi + 1]:
+            hi += 1
+        if hi - lo < 2:
+            lo = i - 1
+            hi = i + 1
+        xs = x[lo:hi+1]
+        fs = f[lo:hi+1]
+        if np.any(fs <= 0):
+            return x[i]
+        p = np.polyfit(xs - x[i], np.log(fs), 2)
+        if p[0] >= 0:
+            return x[i]
+        return x[i] + np.clip(-p[1]/(2*p[0]), xs[0] - x[i], xs[-1] - x[i])
+
+def fly_scan(stage, zidaq, start, stop, duration=1., bins=200, lag=4e-3):
+    """
+    Measure the lockin signal against delay stage position with a single
+    continuous move from start to stop.  Demodulator samples are streamed
+    during the move and mapped to stage position from their timestamps and the
+    motion profile of the scan, then averaged into position bins.
+
+    Args:
+        stage (DelayStage): delay stage.
+        zidaq (ziDAQ): lockin.
+        start (float): scan start. Units (mm)
+        stop (float): scan end. Units (mm)
+        duration (float): approximate time for the scan. Units (s)
+        bins (int): number of position bins.
+        lag (float): demodulator filter delay, ~filter order*tc. Units (s)
+
+    Returns:
+        positions (np array): centers of bins with samples. Units (mm)
+        values (np array): mean signal in each bin.
+    """
+    vel = stage.vel
+    stage.move(start)
+    try:
+        stage.vel = abs(stop - start)/duration
+        # Profile of the scan, the velocity is restored before it is used
+        scan_vel = stage.vel
+        t_move = stage.move_time(start, stop, scan_vel)
+        handles = []
+        def go():
+            handles.append(stage.move(stop, wait=False, timeout=t_move + 1.))
+        samples, t0 = zidaq._poll_samples(t_move + 0.1, trigger=go)
+        handles[0].wait()
+    finally:
+        stage.vel = vel
+
+    # Signal at a sample reflects the stage position one filter delay earlier
+    t = (samples['timestamp'] - t0)/zidaq.clockbase - lag
+    moving = (t >= 0) & (t <= t_move)
+    p = stage.trajectory(start, stop, t[moving], scan_vel)
+    r = ((samples['x']**2 + samples['y']**2)**0.5)[moving]
+
+    edges = np.linspace(min(start, stop), max(start, stop), bins + 1)
+    idx = np.clip(np.digitize(p, edges) - 1, 0, bins - 1)
+    counts = np.bincount(idx, minlength=bins)
+    sums = np.bincount(idx, weights=r, minlength=bins)
+    filled = counts > 0
+    return 0.5*(edges[1:] + edges[:-1])[filled], sums[filled]/counts[filled]
@@ -0,0 +1,209 @@
+import numpy as np
+import os
+
+class SpoolFull(Exception):
+    """Exception for frames written to a full FrameSpool"""
+    def __init__(self, capacity):
+        self.msg = 'Spool full, %i frames written.' % (capacity)
+
+    def __str__(self):
+        return self.msg
+
+class FrameSpool(object):
+    """
+    Raw frame spool for long acquisitions: a preallocated, append-only file of
+    fixed-size frame records, memory mapped.  A write is one copy into the
+    mapping, with no per-frame file or HDF5 overhead, and only the pages being
+    written need to be in memory.  The frame count in the header is updated
+    after each record, so other processes can read the spool while it grows.
+    Convert a finished spool to a FrameStore with spool_to_store.
+
+    Layout:
+        header (header_size bytes): magic, version, rows, cols, dtype,
+            capacity, count
+        records (capacity,): timestamp (float64), frame (rows, cols)
+
+    Create a spool with FrameSpool.create, open one with FrameSpool.open.
+
+    Args:
+        path (str): spool file.
+        mode (str): 'r' to read, 'r+' to append.
+    """
+    magic = b'FRMSPOOL'
+    version = 1
+    header_size = 4096 # One page, records start page aligned
+    _header_dtype = np.dtype([('magic', 'S8'), ('version', '<u4'), ('rows', '<u4'),
+                              ('cols', '<u4'), ('dtype', 'S16'),
+                              ('capacity', '<i8'), ('count', '<i8')])
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self._header = np.memmap(path, dtype=self._header_dtype, mode=mode, shape=(1,))
+        header = self._header[0]
+        if header['magic'] != self.magic:
+            raise ValueError('%s is not a frame spool' % (path))
+        if header['version'] != self.version:
+            raise ValueError('Unknown spool version %i' % (header['version']))
+        self.shape = (int(header['rows']), int(header['cols']))
+        self.dtype = np.dtype(header['dtype'].decode())
+        self.capacity = int(header['capacity'])
+        self.record_dtype = self._record_dtype(self.shape, self.dtype)
+        self._records = np.memmap(path, dtype=self.record_dtype, mode=mode,
+                                  offset=self.header_size, shape=(self.capacity,))
+
+    @classmethod
+    def _record_dtype(cls, shape, dtype):
+        return np.dtype([('timestamp', '<f8'), ('frame', dtype, shape)])
+
+    @classmethod
+    def create(cls, path, shape, capacity, dtype=np.float64):
+        """
+        Create a spool file of capacity frames.  The file is sized up front,
+        sparse where the filesystem allows.
+
+        Args:
+            path (str): spool file, overwritten.
+            shape (tuple): frame shape, (rows, cols).
+            capacity (int): largest number of frames.
+            dtype (np dtype): frame data type.
+
+        Returns:
+            spool (FrameSpool): spool open for appending.
+        """
+        record = cls._record_dtype(tuple(shape), np.dtype(dtype))
+        with open(path, 'wb') as f:
+            f.truncate(cls.header_size + capacity*record.itemsize)
+        header = np.memmap(path, dtype=cls._header_dtype, mode='r+', shape=(1,))
+        header[0] = (cls.magic, cls.version, shape[0], shape[1],
+                     np.dtype(dtype).str.encode(), capacity, 0)
+        header.flush()
+        del header
+        return cls(path, 'r+')
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        """Open an existing spool, see FrameSpool"""
+        return cls(path, mode)
+
+    @staticmethod
+    def capacity_for(shape, dtype, max_bytes):
+        """Return the number of frames that fit in max_bytes"""
+        return int(max_bytes//FrameSpool._record_dtype(tuple(shape), np.dtype(dtype)).itemsize)
+
+    def __len__(self):
+        return int(self._header['count'][0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    ############################################################################
+    # Writing
+
+    def slot(self):
+        """
+        Return the frame of the next record, to fill in place before commit.
+
+        Raises:
+            SpoolFull: no record left.
+        """
+        n = len(self)
+        if n >= self.capacity:
+            raise SpoolFull(self.capacity)
+        return self._records['frame'][n]
+
+    def commit(self, timestamp=0.):
+        """
+        Add the record filled through slot.
+
+        Returns:
+            index (int): index of the frame.
+        """
+        n = len(self)
+        self._records['timestamp'][n] = timestamp
+        # Count last, readers never see a partly written record
+        self._header['count'][0] = n + 1
+        return n
+
+    def write(self, frame, timestamp=0.):
+        """
+        Append a frame, copied straight into the mapping.
+
+        Args:
+            frame (np array): frame of the spool shape.
+            timestamp (float): frame timestamp.
+
+        Returns:
+            index (int): index of the frame.
+
+        Raises:
+            SpoolFull: no record left.
+        """
+        self.slot()[...] = frame
+        return self.commit(timestamp)
+
+    def flush(self):
+        """Write changed pages to disk"""
+        self._records.flush()
+        self._header.flush()
+
+    def close(self):
+        """Flush and unmap the spool"""
+        if self._records is None:
+            return
+        if self._records.mode == 'r+':
+            self.flush()
+        self._records = None
+        self._header = None
+
+    ############################################################################
+    # Reading
+
+    @property
+    def frames(self):
+        """Property to return the written frames, a view of the mapping"""
+        return self._records['frame'][:len(self)]
+
+    @property
+    def timestamps(self):
+        """Property to return the timestamps of the written frames"""
+        return self._records['timestamp'][:len(self)]
+
+    def read(self, index=slice(None)):
+        """
+        Read frames, as views of the mapping.
+
+        Args:
+            index (int/slice): frame index or slice.
+        """
+        return self.frames[index]
+
+    @property
+    def nbytes(self):
+        """Property to return the size of the spool file. Units (bytes)"""
+        return os.path.getsize(self.path)
+
+def spool_to_store(spool, store, batch=64):
+    """
+    Copy the frames of a spool to a FrameStore, batch frames per write, with
+    the frame timestamps as per-frame metadata.
+
+        with FrameSpool.open(path) as spool:
+            spool_to_store(spool, data.new_acquisition(spool.shape, meta, spool.dtype))
+
+    Args:
+        spool (FrameSpool): spool to convert.
+        store (FrameStore): store of the spool frame shape.
+        batch (int): frames per write.
+
+    Returns:
+        count (int): frames copied.
+    """
+    n = len(spool)
+    for i in range(0, n, batch):
+        j = min(i + batch, n)
+        store.extend(spool.read(slice(i, j)),
+                     [{'timestamp': float(t)} for t in spool.timestamps[i:j]])
+    return n
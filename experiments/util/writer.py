@@ -0,0 +1,211 @@
+import numpy as np
+import queue
+import threading
+import time
+
+class WriterFull(Exception):
+    """Exception for frames put to a full AsyncWriter with the 'raise' policy"""
+    def __init__(self, maxsize):
+        self.msg = 'Writer queue full, %i frames waiting.' % (maxsize)
+
+    def __str__(self):
+        return self.msg
+
+class AsyncWriter(object):
+    """
+    Background thread writing frames to FrameStores, so acquisition never waits
+    on the disk.  Frames are copied into a bounded queue.  The thread takes up
+    to batch frames at a time, writes consecutive frames of the same store with
+    one extend call, and flushes the file every flush_period.
+
+    Backpressure policies, when the queue is full:
+        'block': wait for space, at most timeout, then drop the frame.
+        'drop': drop the frame.
+        'raise': raise WriterFull.
+
+    Args:
+        maxsize (int): largest number of frames waiting.
+        policy (str): backpressure policy, see above.
+        batch (int): largest number of frames per write.
+        flush_period (float): time between file flushes. Units (s)
+        timeout (float): longest wait with the 'block' policy, None to wait
+            forever. Units (s)
+    """
+    _policies = ['block', 'drop', 'raise']
+
+    def __init__(self, maxsize=64, policy='block', batch=16, flush_period=1.,
+                 timeout=None):
+        if policy not in self._policies:
+            raise ValueError('Unknown backpressure policy %s' % (policy))
+        self.policy = policy
+        self.batch = batch
+        self.flush_period = flush_period
+        self.timeout = timeout
+
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._files = set() # Files written since the last flush
+        self.reset_stats()
+
+        self._thread = threading.Thread(name='HDF5 Writer Thread', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def reset_stats(self):
+        """Clear the write statistics"""
+        with self._lock:
+            self.t_start = time.monotonic()
+            self.queued = 0
+            self.written = 0
+            self.dropped = 0
+            self.writes = 0
+            self.flushes = 0
+            self.bytes_written = 0
+            self.write_time = 0.
+            self.backlog_max = 0
+            self.last_error = None
+
+    ############################################################################
+    # Producer
+
+    def put(self, store, frame, meta=None):
+        """
+        Queue a frame to append to a store.  The frame is copied.
+
+        Args:
+            store (FrameStore): store to append to.
+            frame (np array): frame of the store shape.
+            meta (dict): per-frame metadata.
+
+        Returns:
+            queued (bool): False if the frame was dropped.
+        """
+        item = (store, np.array(frame), meta)
+        try:
+            if self.policy == 'block':
+                self._queue.put(item, timeout=self.timeout)
+            else:
+                self._queue.put_nowait(item)
+        except queue.Full:
+            if self.policy == 'raise':
+                raise WriterFull(self._queue.maxsize)
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.queued += 1
+            self.backlog_max = max(self.backlog_max, self._queue.qsize())
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued frame is written and flushed.
+
+        Args:
+            timeout (float): longest wait, None to wait forever. Units (s)
+
+        Returns:
+            done (bool): False on timeout.
+        """
+        done = threading.Event()
+        self._queue.put((None, done, None))
+        return done.wait(timeout)
+
+    def close(self, timeout=None):
+        """Write all queued frames, flush and stop the thread"""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    ############################################################################
+    # Writer thread
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_period
+        while 1:
+            try:
+                items = [self._queue.get(timeout=max(next_flush - time.monotonic(), 0))]
+            except queue.Empty:
+                items = []
+            # Take what is already waiting, up to a batch
+            while items and len(items) < self.batch:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in items
+            if stop:
+                items = items[:items.index(None)]
+            events = [frame for store, frame, meta in items if store is None]
+            self._write([item for item in items if item[0] is not None])
+
+            if stop or events or time.monotonic() >= next_flush:
+                self._flush()
+                next_flush = time.monotonic() + self.flush_period
+                for event in events:
+                    event.set()
+            if stop:
+                return
+
+    def _write(self, items):
+        """Write items, consecutive frames of a store in one extend"""
+        i = 0
+        while i < len(items):
+            store = items[i][0]
+            j = i
+            while j < len(items) and items[j][0] is store:
+                j += 1
+            frames = np.stack([frame for s, frame, meta in items[i:j]])
+            meta = [meta or {} for s, frame, meta in items[i:j]]
+            t = time.monotonic()
+            try:
+                store.extend(frames, meta if any(meta) else None)
+                self._files.add(store.group.file)
+                with self._lock:
+                    self.written += j - i
+                    self.writes += 1
+                    self.bytes_written += frames.nbytes
+                    self.write_time += time.monotonic() - t
+            except Exception as e:
+                with self._lock:
+                    self.dropped += j - i
+                    self.last_error = str(e)
+            i = j
+
+    def _flush(self):
+        for f in self._files:
+            try:
+                f.flush()
+            except Exception as e:
+                self.last_error = str(e)
+        self._files = set()
+        with self._lock:
+            self.flushes += 1
+
+    ############################################################################
+    # Statistics
+
+    @property
+    def backlog(self):
+        """Property to return the number of frames waiting"""
+        return self._queue.qsize()
+
+    @property
+    def stats(self):
+        """
+        Property to return write statistics: frames queued, written and dropped,
+        backlog, write calls, bytes written, bandwidth while writing and average
+        bandwidth since reset. Units (bytes/s)
+        """
+        with self._lock:
+            elapsed = max(time.monotonic() - self.t_start, 1e-9)
+            return {'queued': self.queued,
+                    'written': self.written,
+                    'dropped': self.dropped,
+                    'backlog': self._queue.qsize(),
+                    'backlog_max': self.backlog_max,
+                    'writes': self.writes,
+                    'flushes': self.flushes,
+                    'bytes_written': self.bytes_written,
+                    'write_bandwidth': self.bytes_written/self.write_time if self.write_time else 0.,
+                    'bandwidth': self.bytes_written/elapsed}